@@ -0,0 +1,116 @@
+import io
+import os
+import re
+import subprocess
+import time
+
+from progress import ProgressState
+
+class BlockDeployer(object):
+    ''' Writes the used blocks of an ext2/3/4 image straight onto a partition.
+
+        The block bitmap (as reported by dumpe2fs) tells which blocks are in
+        use, free blocks are never read nor written. Afterwards the
+        filesystem gets a new UUID and is grown to the partition size. '''
+
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, image, device, progress=None):
+        self.image = image
+        self.device = device
+        if progress is None:
+            progress = ProgressState()
+        self.progress = progress
+        self.block_size = 0
+        self.block_count = 0
+
+    def read_bitmap(self):
+        ''' Returns the used block ranges of the image as (start, end) pairs,
+            end being exclusive '''
+        output = subprocess.Popen(["dumpe2fs", self.image], stdout=subprocess.PIPE, stderr=open(os.devnull, "w")).communicate()[0]
+        free = []
+        in_groups = False
+        for line in output.splitlines():
+            # the header has a "Free blocks:" line too, holding the count
+            if line.startswith("Group "):
+                in_groups = True
+            line = line.strip()
+            if line.startswith("Block size:"):
+                self.block_size = int(line.split(":")[1])
+            elif line.startswith("Block count:"):
+                self.block_count = int(line.split(":")[1])
+            elif in_groups and line.startswith("Free blocks:"):
+                for block_range in line.split(":", 1)[1].split(","):
+                    block_range = block_range.strip()
+                    if not re.match(r"^\d+(-\d+)?$", block_range):
+                        continue
+                    if "-" in block_range:
+                        (start, end) = block_range.split("-")
+                    else:
+                        start = end = block_range
+                    free.append((int(start), int(end) + 1))
+        if not self.block_size or not self.block_count:
+            raise IOError("Could not read the block bitmap of %s" % self.image)
+
+        used = []
+        position = 0
+        for (start, end) in sorted(free):
+            if start > position:
+                used.append((position, start))
+            position = max(position, end)
+        if position < self.block_count:
+            used.append((position, self.block_count))
+        return used
+
+    def image_size(self):
+        ''' Size of the filesystem in the image, in bytes '''
+        if not self.block_count:
+            self.read_bitmap()
+        return self.block_count * self.block_size
+
+    def run(self):
+        used = self.read_bitmap()
+        used_bytes = sum([end - start for (start, end) in used]) * self.block_size
+        chunks = sum([((end - start) * self.block_size + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE for (start, end) in used])
+        print " --> Deploying %s on %s (%d of %d MB used)" % (self.image, self.device, used_bytes // 1048576, self.image_size() // 1048576)
+        self.progress.start_counting(chunks, used_bytes, "Writing root filesystem to %s" % self.device, unit="blocks")
+
+        buf = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buf)
+        src = io.open(self.image, "rb", buffering=0)
+        dst = io.open(self.device, "r+b", buffering=0)
+        try:
+            for (start, end) in used:
+                offset = start * self.block_size
+                remaining = (end - start) * self.block_size
+                src.seek(offset)
+                dst.seek(offset)
+                while(remaining > 0):
+                    read = src.readinto(view[:min(remaining, self.CHUNK_SIZE)])
+                    if not read:
+                        raise IOError("Unexpected end of %s" % self.image)
+                    written = 0
+                    while(written < read):
+                        written += dst.write(view[written:read])
+                    remaining -= read
+                    self.progress.advance("Writing root filesystem to %s" % self.device, read)
+            os.fsync(dst.fileno())
+        finally:
+            src.close()
+            dst.close()
+
+        # The copy carries the UUID of the image, make it unique and use
+        # the whole partition
+        self.progress.begin_stage("resize", "Resizing root filesystem")
+        self.check_call(["e2fsck", "-f", "-y", self.device], accept=(0, 1))
+        self.check_call(["tune2fs", "-U", "random", self.device])
+        self.check_call(["resize2fs", self.device])
+
+    def check_call(self, cmd, accept=(0,)):
+        print "EXECUTING: '%s'" % " ".join(cmd)
+        start = time.time()
+        returncode = subprocess.call(cmd)
+        if self.progress.events is not None:
+            self.progress.events.command(" ".join(cmd), start, time.time(), returncode)
+        if returncode not in accept:
+            raise IOError("'%s' failed with exit code %d" % (" ".join(cmd), returncode))
@@ -0,0 +1,69 @@
+import subprocess
+import uuid
+
+def shell_quote(text):
+    return "'%s'" % text.replace("'", "'\\''")
+
+class ChrootSession(object):
+    ''' A shell inside root which runs the commands written to its stdin,
+        one after another. The chroot and the shell are only started once.
+
+        Every command is run with eval in a subshell, so it can't end or
+        change the session, with stdin from /dev/null and stderr merged
+        into stdout. It is followed by a marker line holding a token of
+        the session, the number of the command and its exit status, which
+        ends the output of the command. '''
+
+    def __init__(self, root, shell="/usr/bin/sh"):
+        self.root = root
+        self.shell = shell
+        self.process = None
+        self.token = uuid.uuid4().hex
+        self.count = 0
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        print " --> Starting a shell in %s" % self.root
+        self.process = subprocess.Popen(["chroot", self.root, self.shell], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+
+    def run(self, command, callback=None):
+        ''' Run command, callback gets every line of its output. Returns the
+            exit status, 255 if the shell itself went away. '''
+        if not self.alive():
+            self.start()
+        self.count += 1
+        marker = "%s %d " % (self.token, self.count)
+        self.process.stdin.write("( eval %s ) </dev/null 2>&1\nprintf '%%s%%d\\n' '%s' \"$?\"\n" % (shell_quote(command), marker))
+        self.process.stdin.flush()
+        for line in iter(self.process.stdout.readline, ""):
+            line = line.rstrip("\n")
+            index = line.find(marker)
+            if index >= 0:
+                # output without a final newline
+                if index > 0 and callback is not None:
+                    callback(line[:index])
+                return int(line[index + len(marker):])
+            if callback is not None:
+                callback(line)
+        print " --> The shell in %s exited" % self.root
+        self.process.wait()
+        self.process = None
+        return 255
+
+    def close(self):
+        ''' End the shell, nothing of it stays in root '''
+        if self.process is None:
+            return
+        if self.alive():
+            try:
+                self.process.stdin.write("exit\n")
+                self.process.stdin.close()
+            except IOError:
+                pass
+            # anything a command left behind
+            self.process.stdout.read()
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
@@ -0,0 +1,909 @@
+import array
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import functools
+import hashlib
+import heapq
+import io
+import os
+import re
+import stat
+import struct
+import sys
+import threading
+import time
+import Queue
+
+from progress import ProgressState
+
+# Kernel side copy helpers, python2 has no wrappers for them
+libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+_copy_file_range = getattr(libc, "copy_file_range", None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+
+_syncfs = getattr(libc, "syncfs", None)
+if _syncfs is not None:
+    _syncfs.argtypes = [ctypes.c_int]
+    _syncfs.restype = ctypes.c_int
+libc.sync.restype = None
+
+_sendfile = getattr(libc, "sendfile64", None) or getattr(libc, "sendfile", None)
+if _sendfile is not None:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+_posix_fadvise = getattr(libc, "posix_fadvise64", None) or getattr(libc, "posix_fadvise", None)
+if _posix_fadvise is not None:
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    _posix_fadvise.restype = ctypes.c_int
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+_futimens = getattr(libc, "futimens", None)
+if _futimens is not None:
+    _futimens.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    _futimens.restype = ctypes.c_int
+
+# _IOW(0x94, 9, int), clone the extents of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+# _IOWR('f', 11, struct fiemap), maps the extents of a file to the device
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap without its extents, and struct fiemap_extent
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+# Largest amount handed to the kernel in one call
+KERNEL_CHUNK = 1024 * 1024 * 1024
+
+# Errors meaning "not possible for this pair of files", try the next method
+FALLBACK_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+# Not exported by python2
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# Holes read as zeros, they are hashed from here
+ZEROS = "\0" * (1024 * 1024)
+
+COPY_METHODS = ("copy_file_range", "sendfile", "reflink", "buffer", "pipeline")
+
+# When file data goes through the reader/writer pipeline:
+#   auto - for files which are copied through a buffer anyway (verify)
+#   yes  - for all files, the kernel copy paths aren't used
+#   no   - never
+PIPELINE_MODES = ("auto", "yes", "no")
+
+# Order in which regular files are read from the source:
+#   walk   - manifest order
+#   inode  - inode number, which follows the allocation order on ext*
+#   extent - the physical offset of the first extent (FIEMAP)
+READ_ORDERS = ("walk", "inode", "extent")
+
+def kernel_call(func, *args):
+    result = func(*args)
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+def fadvise(fd, advice):
+    ''' Hint the page cache about the whole file, failures don't matter '''
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, 0, 0, advice)
+
+def set_file_times(fd, path, atime, mtime):
+    ''' os.utime() through an open file, python2 has no futimes '''
+    if _futimens is None:
+        os.utime(path, (atime, mtime))
+        return
+    times = (timespec * 2)()
+    for (i, value) in enumerate((atime, mtime)):
+        times[i].tv_sec = int(value)
+        times[i].tv_nsec = int(round((value - int(value)) * 1e9)) % 1000000000
+    kernel_call(_futimens, fd, times)
+
+def mount_points(root):
+    ''' root and the filesystems mounted below it '''
+    root = os.path.realpath(root)
+    points = [root]
+    fh = open("/proc/self/mounts", "r")
+    try:
+        for line in fh:
+            # spaces are escaped as \040
+            point = line.split()[1].decode("string_escape")
+            if point.startswith(root.rstrip("/") + "/") and point not in points:
+                points.append(point)
+    finally:
+        fh.close()
+    return points
+
+def first_extent(path):
+    ''' Physical offset of the first extent of path, 0 if it has no data '''
+    buf = array.array("B", FIEMAP_HEADER.pack(0, 0xffffffffffffffff, 0, 0, 1, 0) + "\0" * FIEMAP_EXTENT.size)
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+    finally:
+        os.close(fd)
+    if not FIEMAP_HEADER.unpack_from(buf)[3]:
+        return 0
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
+
+def translate_component(pattern):
+    ''' Regular expression of a shell pattern for one path component '''
+    regex = ""
+    i = 0
+    while(i < len(pattern)):
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[" and pattern.find("]", i + 1) > 0:
+            end = pattern.find("]", i + 1)
+            chars = pattern[i:end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex += "[%s]" % chars
+            i = end + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+class ExcludeRules(object):
+    ''' Paths of the root image which are not installed.
+
+        Shell patterns relative to the root of the tree, like
+        /etc/skel/Desktop/*.desktop. Wildcards don't match "/", and a
+        matching directory excludes everything below it. All patterns are
+        compiled into a single regular expression. Literal paths added
+        with add_paths() are looked up in a set. '''
+
+    def __init__(self, patterns):
+        self.paths = set()
+        self.patterns = []
+        for pattern in patterns:
+            pattern = pattern.strip().strip("/")
+            if pattern and not pattern.startswith("#"):
+                self.patterns.append(pattern.split("/"))
+        self.regex = None
+        if self.patterns:
+            self.regex = re.compile("(?:%s)\\Z" % "|".join(["/".join([translate_component(part) for part in parts]) for parts in self.patterns]))
+
+    def __len__(self):
+        return len(self.patterns) + len(self.paths)
+
+    def add_paths(self, paths):
+        ''' Exclude paths relative to the root, taken literally '''
+        self.paths.update([path.strip("/") for path in paths])
+
+    def matches(self, rpath):
+        ''' True if rpath, relative to the root, is excluded '''
+        if rpath in self.paths:
+            return True
+        return self.regex is not None and self.regex.match(rpath) is not None
+
+    def expand(self, root):
+        ''' The excluded paths which exist below root '''
+        found = []
+        for parts in self.patterns:
+            candidates = [root]
+            for part in parts:
+                regex = re.compile(translate_component(part) + r"\Z")
+                matched = []
+                for candidate in candidates:
+                    if not os.path.isdir(candidate) or os.path.islink(candidate):
+                        continue
+                    for name in sorted(os.listdir(candidate)):
+                        if regex.match(name):
+                            matched.append(os.path.join(candidate, name))
+                candidates = matched
+            found.extend(candidates)
+        for path in sorted(self.paths):
+            if os.path.lexists(os.path.join(root, path)):
+                found.append(os.path.join(root, path))
+        return found
+
+class BufferPool(object):
+    ''' A fixed set of reusable copy buffers, get() blocks while all of
+        them are in use '''
+
+    def __init__(self, count, size):
+        self.size = size
+        self.free = Queue.Queue()
+        for i in range(count):
+            self.free.put(bytearray(size))
+
+    def get(self):
+        return self.free.get()
+
+    def put(self, buf):
+        self.free.put(buf)
+
+class CopyJournal(object):
+    ''' Append-only record of the files completely copied to the target.
+
+        New lines are collected and only written after syncfs() made the
+        copied data durable on the filesystems of root, so a recorded file
+        is never a torn one. A crash loses at most the last SYNC_INTERVAL
+        seconds of records. '''
+
+    SYNC_INTERVAL = 5
+
+    def __init__(self, path, resume=False, root=None):
+        self.path = path
+        # a directory of every filesystem of the target
+        self.filesystems = []
+        if root is not None and _syncfs is not None:
+            for point in mount_points(root):
+                try:
+                    self.filesystems.append(os.open(point, os.O_RDONLY))
+                except OSError, e:
+                    print " --> Not syncing %s: %s" % (point, e)
+        # path -> (size, mtime) of the files recorded by a previous run
+        self.done = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.last_sync = time.time()
+        if resume and os.path.exists(path):
+            self.load()
+            self.fh = open(path, "a")
+        else:
+            self.fh = open(path, "w")
+
+    def load(self):
+        fh = open(self.path, "r")
+        try:
+            for line in fh:
+                try:
+                    (size, mtime, path) = line.rstrip("\n").split("\t", 2)
+                    self.done[path.decode("string_escape")] = (int(size), int(mtime))
+                except ValueError:
+                    # a torn last line
+                    pass
+        finally:
+            fh.close()
+
+    def is_done(self, entry, targetpath):
+        ''' True if a previous run copied entry and the target still matches '''
+        if self.done.get(entry.path) != (entry.st_size, int(entry.st_mtime)):
+            return False
+        try:
+            st = os.lstat(targetpath)
+        except OSError:
+            return False
+        return stat.S_ISREG(st.st_mode) and st.st_size == entry.st_size and int(st.st_mtime) == int(entry.st_mtime)
+
+    def record(self, entry):
+        self.lock.acquire()
+        self.pending.append("%d\t%d\t%s\n" % (entry.st_size, int(entry.st_mtime), entry.path.encode("string_escape")))
+        due = time.time() - self.last_sync >= self.SYNC_INTERVAL
+        if due:
+            self.last_sync = time.time()
+        self.lock.release()
+        if due:
+            self.flush()
+
+    def flush(self):
+        self.write_lock.acquire()
+        try:
+            self.lock.acquire()
+            pending = self.pending
+            self.pending = []
+            self.lock.release()
+            if not pending:
+                return
+            # the data of the recorded files first, then the records
+            self.sync()
+            self.fh.write("".join(pending))
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+        finally:
+            self.write_lock.release()
+
+    def sync(self):
+        ''' Write back the target, not every filesystem of the machine '''
+        if not self.filesystems:
+            libc.sync()
+            return
+        for fd in self.filesystems:
+            kernel_call(_syncfs, fd)
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+        for fd in self.filesystems:
+            os.close(fd)
+        self.filesystems = []
+
+class CopyEngine(object):
+    ''' Copies a filesystem tree onto the target.
+
+        Directories, links and special files are created in walk order by
+        the calling thread, regular files are handed to a bounded pool of
+        worker threads which copy the data and apply the metadata.
+
+        With verify set, every file is hashed by its worker while the data
+        passes through the copy buffer. The digest is checked against the
+        manifest if that has one and written to the report file.
+
+        Completed files are recorded in a journal on the target. With resume
+        set, files recorded by a previous run which still match are kept.
+
+        A fresh target (every partition of the tree just formatted) has
+        nothing to replace, so the probes for existing files are skipped.
+
+        Regular files can be read in the physical order of the source
+        (read_order, see READ_ORDERS) instead of the manifest order. The
+        walker keeps the next reorder_window files in a heap and always
+        hands out the lowest one. Directories are still created in walk
+        order, and always before the files that go into them.
+
+        Entries matching the ExcludeRules are skipped by the walker, with
+        all of their subtree, before anything is read or created.
+
+        With the pipeline, every worker reads into buffers of a shared
+        BufferPool and hands them to a writer thread of its own, so the
+        source and the target are busy at the same time. The writer also
+        finishes the file (metadata, journal, progress). The memory used
+        is fixed by the size of the pool. '''
+
+    BUF_SIZE = 1024 * 1024
+
+    def __init__(self, source, destination, manifest, workers=4, progress=None, verify=False, digest="md5", report=None, journal=None, resume=False, fresh=False, read_order="walk", reorder_window=4096, pipeline="auto", pipeline_buffers=32, excludes=None):
+        self.source = source
+        self.destination = destination
+        self.manifest = manifest
+        self.workers = max(1, int(workers))
+        if progress is None:
+            progress = ProgressState()
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.errors = []
+        # Number of files copied by each data path
+        self.methods = dict((method, 0) for method in COPY_METHODS)
+        # Files with holes and the bytes not written because of them
+        self.sparse_files = 0
+        self.sparse_bytes = 0
+        # (st_dev, st_ino) -> target path of files with more than one link
+        self.inodes = {}
+        self.hardlinks = 0
+        self.verify = verify
+        # a digest from the manifest can only be checked with its algorithm
+        self.digest = manifest.digest or digest
+        self.report_path = report
+        self.report = None
+        self.verified = 0
+        self.hashed = 0
+        self.journal_path = journal
+        self.journal = None
+        self.resume = resume
+        self.resumed = 0
+        self.fresh = fresh and not resume
+        self.use_copy_file_range = _copy_file_range is not None
+        self.use_sendfile = _sendfile is not None
+        self.excludes = excludes
+        self.excluded = 0
+        if read_order not in READ_ORDERS:
+            raise ValueError("Unknown read order %s" % read_order)
+        self.read_order = read_order
+        self.reorder_window = max(1, int(reorder_window))
+        if pipeline not in PIPELINE_MODES:
+            raise ValueError("Unknown pipeline mode %s" % pipeline)
+        self.pipeline = pipeline
+        self.pool = None
+        # auto only pipelines what goes through a buffer anyway, without
+        # any such file the buffers and writer threads aren't needed
+        if pipeline == "yes" or (pipeline == "auto" and (self.verify or not (self.use_copy_file_range or self.use_sendfile))):
+            # at least two buffers per worker to keep both sides going
+            self.pool = BufferPool(max(2 * self.workers, int(pipeline_buffers)), self.BUF_SIZE)
+        # (key, sequence, item) of the files waiting to be queued
+        self.window = []
+        self.sequence = 0
+        # Per thread userspace copy buffer
+        self.local = threading.local()
+        # Bounded, so the walker can't run away from the workers
+        self.queue = Queue.Queue(maxsize=self.workers * 64)
+
+    def run(self):
+        ''' Copy the whole tree, returns when every worker has finished '''
+        self.progress.start_counting(self.manifest.count, self.manifest.size, "Copying files")
+
+        print " --> Copying files (%d workers, %s order)" % (self.workers, self.read_order)
+        threads = []
+        writers = []
+        for i in range(self.workers):
+            tasks = None
+            if self.pool is not None:
+                # bounded as well, the finish tasks hold an open file
+                tasks = Queue.Queue(maxsize=self.pool.free.qsize())
+                writer = threading.Thread(target=self.writer, args=(tasks,), name="copy-writer-%d" % i)
+                writer.daemon = True
+                writer.start()
+                writers.append(writer)
+            thread = threading.Thread(target=self.worker, args=(tasks,), name="copy-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        directory_times = []
+        hardlinks = []
+        if self.verify and self.report_path:
+            self.report = open(self.report_path, "w")
+        if self.journal_path:
+            self.journal = CopyJournal(self.journal_path, self.resume, self.destination)
+        try:
+            self.walk(directory_times, hardlinks)
+        finally:
+            for thread in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+            for writer in writers:
+                writer.join()
+            if self.report is not None:
+                self.report.close()
+            if self.journal is not None:
+                self.journal.close()
+
+        if self.errors:
+            exc_info = self.errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        # Every first copy is complete now, the other names are just links
+        for (linkto, targetpath, rpath) in hardlinks:
+            os.link(linkto, targetpath)
+            self.hardlinks += 1
+            self.progress.advance("Linking %s" % rpath)
+
+        # Apply timestamps to all directories now that the items within them
+        # have been copied.
+        print " --> Restoring meta-info"
+        # keeps the byte counters, the copy is done but the stage isn't
+        self.progress.set_message("Restoring meta-information")
+        for dirtime in directory_times:
+            (directory, atime, mtime) = dirtime
+            try:
+                os.utime(directory, (atime, mtime))
+            except OSError:
+                pass
+
+        print " --> Copy statistics: %s" % self.describe_stats()
+
+    def describe_stats(self):
+        ''' Summary of the data paths used and the holes skipped, e.g.
+            "copy_file_range: 1234, holes skipped: 12 MB in 3 files" '''
+        stats = ["%s: %d" % (method, self.methods[method]) for method in COPY_METHODS if self.methods[method]]
+        if self.resumed:
+            stats.append("kept from previous run: %d" % self.resumed)
+        if self.excluded:
+            stats.append("excluded: %d" % self.excluded)
+        if self.hardlinks:
+            stats.append("hard links: %d" % self.hardlinks)
+        if self.verified:
+            stats.append("verified: %d" % self.verified)
+        if self.hashed > self.verified:
+            stats.append("%s recorded: %d" % (self.digest, self.hashed - self.verified))
+        if self.sparse_files:
+            stats.append("holes skipped: %d MB in %d files" % (self.sparse_bytes // 1048576, self.sparse_files))
+        return ", ".join(stats)
+
+    def walk(self, directory_times, hardlinks):
+        source = self.source
+        destination = self.destination
+        # excluded directories
+        pruned = set()
+        # the manifest lists parents before their children
+        for st in self.manifest:
+            # a worker failed, stop feeding the queue
+            if self.errors:
+                return
+            # following is hacked/copied from Ubiquity
+            rpath = st.path
+            if (pruned and os.path.dirname(rpath) in pruned) or (self.excludes and self.excludes.matches(rpath)):
+                if stat.S_ISDIR(st.st_mode):
+                    pruned.add(rpath)
+                self.skip(st)
+                continue
+            sourcepath = os.path.join(source, rpath)
+            targetpath = os.path.join(destination, rpath)
+            mode = stat.S_IMODE(st.st_mode)
+
+            if self.journal is not None and stat.S_ISREG(st.st_mode) and self.journal.is_done(st, targetpath):
+                # copied by the run that died, other names still link to it
+                if st.st_nlink > 1:
+                    self.inodes.setdefault((st.st_dev, st.st_ino), targetpath)
+                self.resumed += 1
+                self.progress.advance("Keeping %s" % rpath, st.st_size)
+                continue
+            if not self.fresh and os.path.exists(targetpath):
+                if not os.path.isdir(targetpath):
+                    os.remove(targetpath)
+            if stat.S_ISREG(st.st_mode):
+                if st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    if key in self.inodes:
+                        hardlinks.append((self.inodes[key], targetpath, rpath))
+                        continue
+                    self.inodes[key] = targetpath
+                # data and metadata are handled by the workers
+                self.schedule((rpath, sourcepath, targetpath, st))
+                continue
+            elif stat.S_ISLNK(st.st_mode):
+                if not self.fresh and os.path.lexists(targetpath):
+                    os.unlink(targetpath)
+                os.symlink(st.link, targetpath)
+            elif stat.S_ISDIR(st.st_mode):
+                try:
+                    os.mkdir(targetpath, mode)
+                except OSError, e:
+                    # lost+found and mount points are already there
+                    if e.errno != errno.EEXIST:
+                        raise
+            elif stat.S_ISCHR(st.st_mode):
+                os.mknod(targetpath, stat.S_IFCHR | mode, st.st_rdev)
+            elif stat.S_ISBLK(st.st_mode):
+                os.mknod(targetpath, stat.S_IFBLK | mode, st.st_rdev)
+            elif stat.S_ISFIFO(st.st_mode):
+                os.mknod(targetpath, stat.S_IFIFO | mode)
+            elif stat.S_ISSOCK(st.st_mode):
+                os.mknod(targetpath, stat.S_IFSOCK | mode)
+            os.lchown(targetpath, st.st_uid, st.st_gid)
+            if not stat.S_ISLNK(st.st_mode):
+                os.chmod(targetpath, mode)
+            if stat.S_ISDIR(st.st_mode):
+                directory_times.append((targetpath, st.st_atime, st.st_mtime))
+            # os.utime() sets timestamp of target, not link
+            elif not stat.S_ISLNK(st.st_mode):
+                os.utime(targetpath, (st.st_atime, st.st_mtime))
+            self.progress.advance("Copying %s" % rpath)
+        # the rest of the window
+        while self.window and not self.errors:
+            self.queue.put(heapq.heappop(self.window)[2])
+
+    def skip(self, st):
+        ''' Count an excluded entry as done '''
+        self.excluded += 1
+        size = 0
+        # hard linked data is counted once in the manifest size
+        if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+            size = st.st_size
+        self.progress.advance("Skipping %s" % st.path, size)
+
+    def read_key(self, sourcepath, st):
+        ''' Sort key of a file for the read order '''
+        if self.read_order == "extent":
+            try:
+                return (first_extent(sourcepath), st.st_ino)
+            except (IOError, OSError), e:
+                if e.errno not in FALLBACK_ERRNOS:
+                    raise
+                print " --> No extent maps on the source (%s), reading in inode order" % e
+                self.read_order = "inode"
+        return (0, st.st_ino)
+
+    def schedule(self, item):
+        ''' Queue a regular file for the workers, keeping the files of the
+            reorder window back until a lower one can't show up anymore '''
+        if self.read_order == "walk":
+            self.queue.put(item)
+            return
+        (rpath, sourcepath, targetpath, st) = item
+        self.sequence += 1
+        heapq.heappush(self.window, (self.read_key(sourcepath, st), self.sequence, item))
+        if len(self.window) > self.reorder_window:
+            self.queue.put(heapq.heappop(self.window)[2])
+
+    def worker(self, tasks=None):
+        # the writer of this worker, if the pipeline is used
+        self.local.tasks = tasks
+        while(True):
+            item = self.queue.get()
+            if item is None:
+                break
+            # keep draining after a failure so the walker never blocks
+            if self.errors:
+                continue
+            (rpath, sourcepath, targetpath, st) = item
+            try:
+                self.copy_regular(sourcepath, targetpath, st, functools.partial(self.file_done, rpath, st))
+            except Exception:
+                self.record_error()
+        if tasks is not None:
+            tasks.put(None)
+
+    def writer(self, tasks):
+        ''' Writes the buffers read by one worker, in the order they were
+            read, and finishes the files '''
+        while(True):
+            task = tasks.get()
+            if task is None:
+                break
+            if task[0] == "write":
+                (kind, dst, offset, buf, length) = task
+                try:
+                    if not self.errors:
+                        dst.seek(offset)
+                        view = memoryview(buf)
+                        written = 0
+                        while(written < length):
+                            written += dst.write(view[written:length])
+                except Exception:
+                    self.record_error()
+                self.pool.put(buf)
+            elif task[0] == "close":
+                # the worker failed on this file
+                task[1].close()
+            else:
+                (kind, dst, dest, st, done) = task
+                try:
+                    if not self.errors:
+                        self.finish_file(dst, dest, st)
+                        if done is not None:
+                            done()
+                except Exception:
+                    self.record_error()
+                dst.close()
+
+    def record_error(self):
+        self.lock.acquire()
+        self.errors.append(sys.exc_info())
+        self.lock.release()
+
+    def file_done(self, rpath, st):
+        ''' A file is completely on the target '''
+        if self.journal is not None:
+            self.journal.record(st)
+        self.progress.advance("Copying %s" % rpath, st.st_size)
+
+    def copy_regular(self, sourcepath, targetpath, st, done=None):
+        ''' Copy a regular file and apply its metadata '''
+        if not self.fresh:
+            try:
+                os.unlink(targetpath)
+            except OSError:
+                pass
+        self.do_copy_file(sourcepath, targetpath, st, done)
+
+    def use_pipeline(self, hasher):
+        ''' True if the data of a file goes through the writer thread '''
+        if getattr(self.local, "tasks", None) is None:
+            return False
+        if self.pipeline == "yes":
+            return True
+        # auto, only what would go through the buffer anyway
+        return hasher is not None or not (self.use_copy_file_range or self.use_sendfile)
+
+    def do_copy_file(self, source, dest, st=None, done=None):
+        ''' Copy the data of source to dest. The metadata of st (a manifest
+            entry) is applied through the open file, no path lookups. done
+            is called once the file is complete, which with the pipeline
+            is after this returns. '''
+        hasher = None
+        if self.verify:
+            hasher = hashlib.new(self.digest)
+        tasks = None
+        if self.use_pipeline(hasher):
+            tasks = self.local.tasks
+        src = io.open(source, "rb", buffering=0)
+        try:
+            fadvise(src.fileno(), POSIX_FADV_SEQUENTIAL)
+            dst = io.FileIO(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb")
+            try:
+                src_st = os.fstat(src.fileno())
+                # fewer blocks than bytes, the file has holes
+                if src_st.st_blocks * 512 < src_st.st_size:
+                    method = self.copy_sparse(src, dst, src_st.st_size, hasher, tasks)
+                else:
+                    method = self.copy_data(src, dst, hasher=hasher, tasks=tasks)
+                # before the file is finished, a bad copy is never journaled
+                if hasher is not None:
+                    self.check_digest(source, st, hasher.hexdigest())
+                if tasks is not None:
+                    # queued behind the data, the writer closes dst
+                    tasks.put(("finish", dst, dest, st, done))
+                    dst = None
+                else:
+                    self.finish_file(dst, dest, st)
+                    if done is not None:
+                        done()
+            finally:
+                if dst is not None and tasks is not None:
+                    # there may still be writes queued for it
+                    tasks.put(("close", dst))
+                elif dst is not None:
+                    dst.close()
+            # read once, don't keep it around
+            fadvise(src.fileno(), POSIX_FADV_DONTNEED)
+        finally:
+            src.close()
+        self.lock.acquire()
+        self.methods[method] += 1
+        self.lock.release()
+
+    def finish_file(self, dst, dest, st):
+        ''' Apply the metadata of the manifest entry st through dst '''
+        dst_fd = dst.fileno()
+        if st is not None:
+            os.fchown(dst_fd, st.st_uid, st.st_gid)
+            # after chown, which drops the setuid bits
+            os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+            set_file_times(dst_fd, dest, st.st_atime, st.st_mtime)
+        # starts the writeback, the pages are dropped once they are clean
+        fadvise(dst_fd, POSIX_FADV_DONTNEED)
+
+    def check_digest(self, source, entry, digest):
+        ''' Compare with the digest of the manifest entry and record it '''
+        if entry is not None and getattr(entry, "digest", ""):
+            if entry.digest != digest:
+                raise IOError("Checksum mismatch for %s: expected %s, got %s" % (source, entry.digest, digest))
+        self.lock.acquire()
+        try:
+            self.hashed += 1
+            if entry is not None and getattr(entry, "digest", ""):
+                self.verified += 1
+            if self.report is not None:
+                path = source
+                if entry is not None:
+                    path = "/" + entry.path
+                # the format of md5sum/sha1sum, can be checked with -c
+                self.report.write("%s  %s\n" % (digest, path))
+        finally:
+            self.lock.release()
+
+    def hash_zeros(self, hasher, length):
+        zeros = memoryview(ZEROS)
+        while(length > 0):
+            hasher.update(zeros[:min(length, len(ZEROS))])
+            length -= len(ZEROS)
+
+    def copy_sparse(self, src, dst, size, hasher=None, tasks=None):
+        ''' Copy only the data extents of src, the holes stay unallocated '''
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        method = "buffer"
+        position = 0
+        copied = 0
+        while(position < size):
+            try:
+                data = os.lseek(src_fd, position, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # nothing but a hole up to the end
+                    break
+                if e.errno == errno.EINVAL and position == 0:
+                    # the filesystem can't tell, copy it the normal way
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    return self.copy_data(src, dst, hasher=hasher, tasks=tasks)
+                raise
+            hole = os.lseek(src_fd, data, SEEK_HOLE)
+            os.lseek(src_fd, data, os.SEEK_SET)
+            # the writer seeks by itself
+            if tasks is None:
+                os.lseek(dst_fd, data, os.SEEK_SET)
+            if hasher is not None:
+                self.hash_zeros(hasher, data - position)
+            method = self.copy_data(src, dst, hole - data, hasher, tasks)
+            copied += hole - data
+            position = hole
+        if hasher is not None and position < size:
+            self.hash_zeros(hasher, size - position)
+        # recreates a trailing hole
+        os.ftruncate(dst_fd, size)
+        self.lock.acquire()
+        self.sparse_files += 1
+        self.sparse_bytes += max(0, size - copied)
+        self.lock.release()
+        return method
+
+    def copy_data(self, src, dst, length=None, hasher=None, tasks=None):
+        ''' Copy length bytes (everything if None) from the current offset of
+            src to dst using the cheapest data path that works, returns the
+            name of that path. Hashing needs the data in userspace, so only
+            the buffer is used when there's a hasher. With tasks the data
+            is read into pool buffers and written by the writer thread. '''
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        if tasks is not None:
+            return self.read_to_writer(src, dst, length, hasher, tasks)
+        if hasher is None:
+            if self.use_copy_file_range:
+                (done, length) = self.kernel_copy("copy_file_range", src_fd, dst_fd, length)
+                if done:
+                    return "copy_file_range"
+            if self.use_sendfile:
+                (done, length) = self.kernel_copy("sendfile", src_fd, dst_fd, length)
+                if done:
+                    return "sendfile"
+            # A clone replaces the whole file, only usable if nothing was written yet
+            if length is None and os.lseek(dst_fd, 0, os.SEEK_CUR) == 0:
+                try:
+                    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                    return "reflink"
+                except IOError, e:
+                    if e.errno not in FALLBACK_ERRNOS:
+                        raise
+        # Userspace fallback through a reusable buffer
+        buf = getattr(self.local, "buf", None)
+        if buf is None:
+            buf = self.local.buf = bytearray(self.BUF_SIZE)
+            self.local.view = memoryview(buf)
+        view = self.local.view
+        while(length is None or length > 0):
+            if length is None:
+                read = src.readinto(buf)
+            else:
+                read = src.readinto(view[:min(length, self.BUF_SIZE)])
+                length -= read
+            if not read:
+                break
+            if hasher is not None:
+                hasher.update(view[:read])
+            written = 0
+            while(written < read):
+                written += dst.write(view[written:read])
+        return "buffer"
+
+    def read_to_writer(self, src, dst, length, hasher, tasks):
+        ''' Reading half of the pipeline, the writes are queued for the
+            writer with the offset they belong to '''
+        offset = src.tell()
+        while(length is None or length > 0):
+            buf = self.pool.get()
+            try:
+                if length is None:
+                    read = src.readinto(buf)
+                else:
+                    read = src.readinto(memoryview(buf)[:min(length, self.pool.size)])
+                    length -= read
+            except Exception:
+                self.pool.put(buf)
+                raise
+            if not read:
+                self.pool.put(buf)
+                break
+            if hasher is not None:
+                hasher.update(memoryview(buf)[:read])
+            tasks.put(("write", dst, offset, buf, read))
+            offset += read
+        return "pipeline"
+
+    def kernel_copy(self, method, src_fd, dst_fd, length=None):
+        ''' Copy with copy_file_range or sendfile from the current offsets.
+            Returns (done, remaining length). If the kernel refused the
+            offsets tell the next method where to go on '''
+        while(length is None or length > 0):
+            count = KERNEL_CHUNK
+            if length is not None:
+                count = min(length, KERNEL_CHUNK)
+            try:
+                if method == "copy_file_range":
+                    copied = kernel_call(_copy_file_range, src_fd, None, dst_fd, None, count, 0)
+                else:
+                    copied = kernel_call(_sendfile, dst_fd, src_fd, None, count)
+            except OSError, e:
+                if e.errno not in FALLBACK_ERRNOS:
+                    raise
+                if e.errno == errno.ENOSYS:
+                    # not available on this kernel, don't ask again
+                    setattr(self, "use_%s" % method, False)
+                return (False, length)
+            if copied == 0:
+                # Some filesystems report 0 instead of an error, make sure
+                # we really reached the end
+                return (os.lseek(src_fd, 0, os.SEEK_CUR) >= os.fstat(src_fd).st_size, length)
+            if length is not None:
+                length -= copied
+        return (True, length)
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+class EventLog(object):
+    ''' What an install did, as JSON lines, one object per event.
+
+        "stage" events are written when a stage ends, with its start and
+        end time, duration, status and the bytes and files it processed.
+        "command" events are written for every external command with its
+        command line, exit status and the lines of output. Times are unix
+        timestamps. The file only ever holds the events of one install,
+        nothing is written before start(). '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fh = None
+        # the stage events, for the summary
+        self.stages = []
+
+    def start(self):
+        ''' Begin the log of an install, dropping the one of an earlier try '''
+        self.lock.acquire()
+        try:
+            self.stages = []
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+            if self.path:
+                try:
+                    directory = os.path.dirname(self.path)
+                    if directory and not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    self.fh = open(self.path, "w")
+                except (IOError, OSError), e:
+                    print " --> Could not open the event log %s: %s" % (self.path, e)
+        finally:
+            self.lock.release()
+        self.write("install", status="started", pid=os.getpid())
+
+    def write(self, event, **fields):
+        fields["event"] = event
+        fields.setdefault("time", time.time())
+        line = json.dumps(fields, sort_keys=True)
+        self.lock.acquire()
+        try:
+            if event == "stage":
+                self.stages.append(fields)
+            if self.fh is not None:
+                self.fh.write(line + "\n")
+                # survives the installer crashing
+                self.fh.flush()
+        finally:
+            self.lock.release()
+
+    def stage(self, name, start, end, status="ok", bytes=0, files=0):
+        self.write("stage", name=name, start=start, end=end, duration=round(end - start, 3), status=status, bytes=bytes, files=files)
+
+    def command(self, command, start, end, returncode, lines=0, chroot=False):
+        self.write("command", command=command, start=start, end=end, duration=round(end - start, 3), returncode=returncode, lines=lines, chroot=chroot)
+
+    def summary(self):
+        ''' One line per finished stage: name, duration, status, data '''
+        self.lock.acquire()
+        try:
+            stages = list(self.stages)
+        finally:
+            self.lock.release()
+        rows = []
+        for stage in stages:
+            data = ""
+            if stage["bytes"]:
+                data = "%.1f MB" % (stage["bytes"] / (1024.0 * 1024.0))
+            if stage["files"]:
+                data = ("%s, %d files" % (data, stage["files"])).lstrip(", ")
+            rows.append(("%-12s %8s  %-7s %s" % (stage["name"], format_duration(stage["duration"]), stage["status"], data)).rstrip())
+        return rows
+
+    def copy_to(self, path):
+        ''' Copy the events logged so far to path, e.g. into the target '''
+        if self.path is None or self.fh is None:
+            return
+        self.lock.acquire()
+        try:
+            self.fh.flush()
+            source = open(self.path, "r")
+            try:
+                content = source.read()
+            finally:
+                source.close()
+        finally:
+            self.lock.release()
+        try:
+            fh = open(path, "w")
+            try:
+                fh.write(content)
+            finally:
+                fh.close()
+        except (IOError, OSError), e:
+            print " --> Could not copy the event log to %s: %s" % (path, e)
+
+    def close(self, status="finished"):
+        self.write("install", status=status)
+        self.lock.acquire()
+        try:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+        finally:
+            self.lock.release()
+
+def format_duration(seconds):
+    if seconds < 60:
+        return "%.1fs" % seconds
+    return "%dm%02ds" % (int(seconds) / 60, int(seconds) % 60)
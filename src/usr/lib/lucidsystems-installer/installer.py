@@ -1,4 +1,5 @@
 import os
+import errno
 import subprocess
 import time
 import shutil
@@ -7,10 +8,26 @@ import stat
 import traceback
 import commands
 import sys
+import threading
 import parted
+from functools import partial
 
 from subprocess import Popen
 from configobj import ConfigObj
+from copyengine import CopyEngine, ExcludeRules
+from manifest import load_manifest
+from blockdeploy import BlockDeployer
+from pacmandb import LocalDatabase
+from pacmanplan import TransactionPlan
+from packagesources import PackageSources, parse_repository
+from prefetch import Prefetcher
+from keyring import KeyringSnapshot, MASTER_KEY_UID, master_fingerprints
+from mirrors import MirrorRanker, MirrorCache, parse_mirrorlist, select_mirrors, format_mirrorlist
+from chroot import ChrootSession
+from targetconfig import TargetConfig
+from scheduler import Step, StepScheduler
+from progress import ProgressState, ProgressSampler, StageTimes
+from eventlog import EventLog
 from PyQt4 import QtCore
 
 class InstallerEngine(QtCore.QThread):
@@ -27,15 +44,115 @@ class InstallerEngine(QtCore.QThread):
         self.live_user = configuration['install']['LIVE_USER_NAME']
         self.root_image = configuration['install']['LIVE_MEDIA_ROOT_IMAGE']
         self.root_image_type = configuration['install']['LIVE_MEDIA_ROOT_IMAGE_TYPE']
+        self.root_manifest = configuration['install'].get('LIVE_MEDIA_ROOT_MANIFEST', self.root_image + '.manifest')
+        self.manifest_cache_dir = configuration['install'].get('MANIFEST_CACHE_DIR', '/var/cache/lucidsystems-installer')
+        self.deploy_mode = configuration['install'].get('ROOT_DEPLOY_MODE', 'auto')
+        self.copy_workers = int(configuration['install'].get('COPY_WORKERS', 4))
+        self.read_order = configuration['install'].get('COPY_READ_ORDER', 'inode')
+        self.reorder_window = int(configuration['install'].get('COPY_REORDER_WINDOW', 4096))
+        self.copy_pipeline = configuration['install'].get('COPY_PIPELINE', 'auto')
+        self.pipeline_buffers = int(configuration['install'].get('COPY_PIPELINE_BUFFERS', 32))
+        # one pattern per line, or a comma separated list
+        excludes = configuration['install'].get('COPY_EXCLUDE', '')
+        if isinstance(excludes, basestring):
+            excludes = excludes.splitlines()
+        self.copy_excludes = ExcludeRules(excludes)
+        self.live_packages = configuration['install'].get('LIVE_PACKAGES', ['lucidsystems-installer', 'lucidsystems-livemedia'])
+        if isinstance(self.live_packages, basestring):
+            self.live_packages = [self.live_packages]
+        self.live_directories = set()
+        # package files on this machine, used before downloading
+        caches = configuration['install'].get('PACKAGE_CACHES', ['/var/cache/pacman/pkg'])
+        if isinstance(caches, basestring):
+            caches = [caches]
+        repositories = configuration['install'].get('LOCAL_REPOSITORIES', [])
+        if isinstance(repositories, basestring):
+            repositories = [repositories]
+        self.package_sources = PackageSources("/target/", self.do_run, [cache for cache in caches if cache], [parse_repository(entry) for entry in repositories if entry])
+        # auto uses the keyring snapshot if there is one, generate builds the
+        # keyring from scratch
+        self.keyring_mode = configuration['install'].get('KEYRING_MODE', 'auto')
+        self.keyring_snapshot = KeyringSnapshot(configuration['install'].get('KEYRING_SNAPSHOT', '/etc/pacman.d/gnupg'))
+        self.keyring_refresh = configuration['install'].get('KEYRING_REFRESH', 'no').lower() in ('yes', 'true', 'on', '1')
+        self.keyring_refresh_timeout = int(configuration['install'].get('KEYRING_REFRESH_TIMEOUT', 120))
+        # mirrors are ranked by the installer, the ranking is reused for a while
+        self.mirror_count = int(configuration['install'].get('MIRROR_COUNT', 8))
+        self.mirror_timeout = float(configuration['install'].get('MIRROR_TIMEOUT', 5))
+        self.mirror_candidates = int(configuration['install'].get('MIRROR_CANDIDATES', 40))
+        self.mirror_countries = configuration['install'].get('MIRROR_COUNTRIES', [])
+        if isinstance(self.mirror_countries, basestring):
+            self.mirror_countries = [self.mirror_countries]
+        self.mirror_countries = [country for country in self.mirror_countries if country]
+        self.mirror_max_lag = int(configuration['install'].get('MIRROR_MAX_LAG', 3600))
+        self.mirror_cache = MirrorCache(configuration['install'].get('MIRROR_CACHE', '/var/cache/lucidsystems-installer/mirrors.json'), int(configuration['install'].get('MIRROR_CACHE_TTL', 3600)))
+        # download the packages while the files are copied
+        self.prefetch = configuration['install'].get('PREFETCH_PACKAGES', 'yes').lower() in ('yes', 'true', 'on', '1')
+        self.prefetcher = None
+        self.verify_copy = configuration['install'].get('VERIFY_COPY', 'no').lower() in ('yes', 'true', 'on', '1')
+        self.verify_digest = configuration['install'].get('VERIFY_DIGEST', 'md5')
+        self.verify_report = '/var/log/lucidsystems-installer-verify.log'
+        # Relative to the target, records the files already copied
+        self.copy_journal = '.lucidsystems-installer-copy.journal'
+        # Continue an install that died during the copy stage
+        self.resume = "--resume" in sys.argv
+        self.progress_rate = int(configuration['install'].get('PROGRESS_RATE', 15))
+        # durations of the previous installs, to estimate the time left
+        self.stage_times = StageTimes(configuration['install'].get('STAGE_TIMES', '/var/cache/lucidsystems-installer/stage-times.json'))
+        # steps configuring the target at the same time
+        self.post_install_jobs = int(configuration['install'].get('POST_INSTALL_JOBS', 4))
+        # what every stage and command did, also copied to the target
+        self.event_log = configuration['install'].get('EVENT_LOG', '/var/log/lucidsystems-installer-events.jsonl')
+        self.events = EventLog(self.event_log)
+        self.progress = ProgressState(self.stage_times, self.events)
+        self.sampler = None
+        # the shells running commands inside the target, one per thread,
+        # started on first use
+        self.chroot_local = threading.local()
+        self.chroot_sessions = []
+        self.chroot_lock = threading.Lock()
+        # plain files of the target are written directly
+        self.target_config = TargetConfig("/target/")
 
     def __del__(self):
         self.wait()
 
     def run(self):
-        self.install(self.setup)
+        self.sampler = ProgressSampler(self.progress, self.emit_progress, self.progress_rate)
+        self.sampler.start()
+        try:
+            self.install(self.setup)
+        finally:
+            self.close_chroot()
+            self.package_sources.release()
+            self.sampler.stop()
 
     def update_progress(self, total, current, message):
-        self.emit(QtCore.SIGNAL("progressUpdate(int, int, QString)"), total, current, QtCore.QString(message))
+        ''' Only records the progress, the sampler sends it to the UI '''
+        self.progress.update(total, current, message)
+
+    def begin_stage(self, stage, message):
+        print " --> %s" % message
+        self.progress.begin_stage(stage, message)
+
+    def plan_stages(self, setup, block_deploy):
+        ''' The stages install() is going to run, in order '''
+        stages = []
+        if not self.resume:
+            stages.append("format")
+        if block_deploy:
+            stages.extend(["deploy", "resize", "mount"])
+        else:
+            stages.extend(["mount", "index", "copy"])
+        if self.prefetch_packages(setup):
+            stages.append("prefetch")
+        stages.extend([step.name for step in self.post_copy_steps(setup)])
+        stages.append("unmount")
+        return stages
+
+    def emit_progress(self, snapshot):
+        # the bar shows the whole install, in steps of 0.1%
+        self.emit(QtCore.SIGNAL("progressUpdate(int, int, QString)"), 1000, int(snapshot['fraction'] * 1000), QtCore.QString(snapshot['message']))
+        self.emit(QtCore.SIGNAL("progressStats(PyQt_PyObject)"), snapshot)
 
     def update_progressTextEdit(self, text):
         self.emit(QtCore.SIGNAL("progressUpdateTextEdit(QString)"), QtCore.QString(text))
@@ -49,38 +166,94 @@ class InstallerEngine(QtCore.QThread):
     def get_installer_version(self):
         return self.installer_version
 
-    def step_format_partitions(self, setup):
+    def get_root_partition(self, setup):
+        for partition in setup.partitions:
+            if partition.mount_as == "/":
+                return partition
+        return None
+
+    def use_block_deploy(self, setup):
+        ''' Decide if the root image can be written block by block.
+            That's only possible if / is formatted with the filesystem of
+            the image and no other partition takes a part of the tree. '''
+        if self.deploy_mode not in ("auto", "block"):
+            return False
+        # the filesystem already holds the files of the previous run
+        if self.resume:
+            return False
+        if not self.root_image_type.startswith("ext"):
+            return False
+        root = self.get_root_partition(setup)
+        if root is None or root.format_as != self.root_image_type:
+            return False
+        for partition in setup.partitions:
+            if partition is root or partition.mount_as in (None, "", "None", "swap"):
+                continue
+            # the efi system partition is empty in the image
+            if self.setup.bios_type == "efi" and partition.mount_as == setup.bootloader_device:
+                continue
+            print " --> Not deploying the root image block by block, %s is a separate partition" % partition.mount_as
+            return False
+        try:
+            image_size = BlockDeployer(self.root_image, root.partition.path).image_size()
+        except Exception:
+            print '-'*60
+            traceback.print_exc(file=sys.stdout)
+            print '-'*60
+            return False
+        partition_size = root.partition.geometry.length * root.partition.disk.device.sectorSize
+        if image_size > partition_size:
+            print " --> Not deploying the root image block by block, %s is too small" % root.partition.path
+            return False
+        return True
+
+    def is_fresh_target(self, setup):
+        ''' True if every partition of the target tree was just formatted '''
+        if self.resume:
+            return False
+        for partition in setup.partitions:
+            if partition.mount_as in (None, "", "None", "swap"):
+                continue
+            if partition.format_as in (None, "", "None"):
+                return False
+        return True
+
+    def step_format_partitions(self, setup, skip_root=False):
+        self.begin_stage("format", "Formatting partitions")
+        partitions = []
         for partition in setup.partitions:                    
+            if(skip_root and partition.mount_as == "/"):
+                continue
             if(partition.format_as is not None and partition.format_as != "" and partition.format_as != "None"):                
-                # report it. should grab the total count of filesystems to be formatted ..
-                self.update_progress(total=4, current=1, message="Formatting %(partition)s as %(format)s..." % {'partition':partition.partition.path, 'format':partition.format_as})
-                
-                if (partition.format_as == "fat16"):
-                    partition.format_as = "msdos"
-                elif (partition.format_as == "fat32"):
-                    partition.format_as = "vfat"
-                
-                #Format it
-                if partition.format_as == "swap":
-                    cmd = "mkswap %s" % partition.partition.path
+                partitions.append(partition)
+        for partition in partitions:
+            # report it
+            self.update_progress(total=len(partitions), current=partitions.index(partition), message="Formatting %(partition)s as %(format)s..." % {'partition':partition.partition.path, 'format':partition.format_as})
+            
+            if (partition.format_as == "fat16"):
+                partition.format_as = "msdos"
+            elif (partition.format_as == "fat32"):
+                partition.format_as = "vfat"
+            
+            #Format it
+            if partition.format_as == "swap":
+                cmd = "mkswap %s" % partition.partition.path
+            else:
+                if (partition.format_as == "jfs"):
+                    cmd = "mkfs.%s -q %s" % (partition.format_as, partition.partition.path)
+                elif (partition.format_as == "xfs"):
+                    cmd = "mkfs.%s -f %s" % (partition.format_as, partition.partition.path)
+                elif (partition.format_as == "vfat"):
+                    cmd = "mkfs.%s -F32 %s" % (partition.format_as, partition.partition.path)
                 else:
-                    if (partition.format_as == "jfs"):
-                        cmd = "mkfs.%s -q %s" % (partition.format_as, partition.partition.path)
-                    elif (partition.format_as == "xfs"):
-                        cmd = "mkfs.%s -f %s" % (partition.format_as, partition.partition.path)
-                    elif (partition.format_as == "vfat"):
-                        cmd = "mkfs.%s -F32 %s" % (partition.format_as, partition.partition.path)
-                    else:
-                        cmd = "mkfs.%s %s" % (partition.format_as, partition.partition.path) # works with bfs, btrfs, ext2, ext3, ext4, minix, msdos, ntfs
+                    cmd = "mkfs.%s %s" % (partition.format_as, partition.partition.path) # works with bfs, btrfs, ext2, ext3, ext4, minix, msdos, ntfs
 					
-                print "EXECUTING: '%s'" % cmd
-                p = Popen(cmd, shell=True)
-                p.wait() # this blocks
-                partition.type = partition.format_as
+            self.do_run(cmd)
+            partition.type = partition.format_as
                                         
     def step_mount_partitions(self, setup):
         # Mount the installation media
-        print " --> Mounting partitions"
+        self.begin_stage("mount", "Mounting partitions")
         self.update_progress(total=3, current=2, message="Mounting %(partition)s on %(mountpoint)s" % {'partition':self.root_image, 'mountpoint':"/source/rootfs/"})
         print " ------ Mounting %s on %s" % (self.root_image, "/source/rootfs/")
         self.do_mount(self.root_image, "/source/rootfs/", self.root_image_type, options="loop")
@@ -108,7 +281,7 @@ class InstallerEngine(QtCore.QThread):
                 if(partition.mount_as is not None and partition.mount_as != ""):   
                     if partition.mount_as == "/boot":
                             print " ------ Mounting %s on %s" % (partition.partition.path, "/target" + partition.mount_as)
-                            self.do_run("mkdir -p /target" + partition.mount_as)
+                            self.target_config.makedirs(partition.mount_as)
                             self.do_mount(partition.partition.path, "/target" + partition.mount_as, partition.type, None)
         
         # Mount the other partitions        
@@ -119,91 +292,74 @@ class InstallerEngine(QtCore.QThread):
                 partition.type = "vfat"
             if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
                 print " ------ Mounting %s on %s" % (partition.partition.path, "/target" + partition.mount_as)
-                self.do_run("mkdir -p /target" + partition.mount_as)
+                self.target_config.makedirs(partition.mount_as)
                 # If the partition type is unknown, try auto
                 if ((partition.type == "None") or (partition.type == "Unknown")):
                     partition.type = "auto"
                 self.do_mount(partition.partition.path, "/target" + partition.mount_as, partition.type, None)
 
+    def step_deploy_image(self, setup):
+        root = self.get_root_partition(setup)
+        self.begin_stage("deploy", "Writing root filesystem to %s" % root.partition.path)
+        deployer = BlockDeployer(self.root_image, root.partition.path, progress=self.progress)
+        deployer.run()
+        root.type = self.root_image_type
+
+    def get_manifest_cache_path(self):
+        ''' Cached manifests are only valid for the exact same image '''
+        st = os.stat(self.root_image)
+        name = "%s-%d-%d.manifest" % (os.path.basename(self.root_image), st.st_size, int(st.st_mtime))
+        return os.path.join(self.manifest_cache_dir, name)
+
     def step_copy_files(self, source, destination):
-        # walk filesystem
-        directory_times = []
-        our_total = 0
-        our_current = -1
-        os.chdir(source)
-        # index the files
-        print " --> Indexing files"
-        for top,dirs,files in os.walk(source, topdown=False):
-            our_total += len(dirs) + len(files)
-            self.update_progress(total=0, current=0, message="Indexing files to be copied..")
-        our_total += 1 # safenessness
-        print " --> Copying files"
-        for top,dirs,files in os.walk(source):
-            # Sanity check. Python is a bit schitzo
-            dirpath = top
-            if(dirpath.startswith(source)):
-                dirpath = dirpath[len(source):]
-            for name in dirs + files:
-                # following is hacked/copied from Ubiquity
-                rpath = os.path.join(dirpath, name)
-                sourcepath = os.path.join(source, rpath)
-                targetpath = os.path.join(destination, rpath)
-                st = os.lstat(sourcepath)
-                mode = stat.S_IMODE(st.st_mode)
-
-                # now show the world what we're doing                    
-                our_current += 1
-                self.update_progress(total=our_total, current=our_current, message="Copying %s" % rpath)
-
-                if os.path.exists(targetpath):
-                    if not os.path.isdir(targetpath):
-                        os.remove(targetpath)                        
-                if stat.S_ISLNK(st.st_mode):
-                    if os.path.lexists(targetpath):
-                        os.unlink(targetpath)
-                    linkto = os.readlink(sourcepath)
-                    os.symlink(linkto, targetpath)
-                elif stat.S_ISDIR(st.st_mode):
-                    if not os.path.isdir(targetpath):
-                        os.mkdir(targetpath, mode)
-                elif stat.S_ISCHR(st.st_mode):                        
-                    os.mknod(targetpath, stat.S_IFCHR | mode, st.st_rdev)
-                elif stat.S_ISBLK(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFBLK | mode, st.st_rdev)
-                elif stat.S_ISFIFO(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFIFO | mode)
-                elif stat.S_ISSOCK(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFSOCK | mode)
-                elif stat.S_ISREG(st.st_mode):
-                    # we don't do blacklisting yet..
-                    try:
-                        os.unlink(targetpath)
-                    except:
-                        pass
-                    self.do_copy_file(sourcepath, targetpath)
-                os.lchown(targetpath, st.st_uid, st.st_gid)
-                if not stat.S_ISLNK(st.st_mode):
-                    os.chmod(targetpath, mode)
-                if stat.S_ISDIR(st.st_mode):
-                    directory_times.append((targetpath, st.st_atime, st.st_mtime))
-                # os.utime() sets timestamp of target, not link
-                elif not stat.S_ISLNK(st.st_mode):
-                    os.utime(targetpath, (st.st_atime, st.st_mtime))
-        # Apply timestamps to all directories now that the items within them
-        # have been copied.
-        print " --> Restoring meta-info"
-        for dirtime in directory_times:
-            (directory, atime, mtime) = dirtime
+        self.begin_stage("index", "Indexing files to be copied..")
+        manifest = load_manifest(source, self.root_manifest, self.get_manifest_cache_path())
+        self.exclude_live_packages(source)
+        self.begin_stage("copy", "Copying files")
+        copier = CopyEngine(source, destination, manifest, workers=self.copy_workers, progress=self.progress, verify=self.verify_copy, digest=self.verify_digest, report=self.verify_report, journal=os.path.join(destination, self.copy_journal), resume=self.resume, fresh=self.is_fresh_target(self.setup), read_order=self.read_order, reorder_window=self.reorder_window, pipeline=self.copy_pipeline, pipeline_buffers=self.pipeline_buffers, excludes=self.copy_excludes)
+        copier.run()
+        self.remove_live_directories(destination)
+        self.update_progressTextEdit("Copy statistics: %s" % copier.describe_stats())
+
+    def exclude_live_packages(self, root):
+        ''' Leave the files of the live-only packages out as if they had
+            been removed with pacman, their database entries included. Their
+            directories are copied, see remove_live_directories(). '''
+        (names, paths, self.live_directories) = LocalDatabase(root).removal_paths(self.live_packages)
+        if names:
+            print " --> Not installing %s (%d paths)" % (", ".join(names), len(paths))
+            self.copy_excludes.add_paths(paths)
+
+    def remove_live_directories(self, root):
+        ''' Remove the directories only the live-only packages owned once
+            they are empty, as pacman does '''
+        # the deepest first, their parents may be empty afterwards
+        for path in sorted(self.live_directories, key=lambda path: path.count("/"), reverse=True):
             try:
-                self.update_progress(total=0, current=0, message="Restoring meta-information on %s" % directory)
-                os.utime(directory, (atime, mtime))
-            except OSError:
-                pass
-        
+                os.rmdir(os.path.join(root, path))
+            except OSError, e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT, errno.ENOTDIR):
+                    raise
+
+    def step_remove_excluded(self, root):
+        ''' The block deploy writes the image as it is, remove what the
+            copy stage would have left out '''
+        self.exclude_live_packages(root)
+        for path in self.copy_excludes.expand(root):
+            # gone with a directory removed before
+            if not os.path.lexists(path):
+                continue
+            print " --> Removing %s" % path
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        self.remove_live_directories(root)
 
     def install(self, setup):
         # mount the media location.
         print " --> Installation started"
+        self.events.start()
         try:
             # create target dir
             if(not os.path.exists("/target")):
@@ -221,286 +377,49 @@ class InstallerEngine(QtCore.QThread):
                 self.error_message(message="The source image doesn't exist! Aborting!", critical=True)
                 self.exit(1)
 
-            # format partitions
-            self.step_format_partitions(setup)
+            # write the root image block by block if the layout allows it
+            block_deploy = self.use_block_deploy(setup)
+            self.progress.plan(self.plan_stages(setup, block_deploy))
+
+            # format partitions, unless we continue on what's already there
+            if self.resume:
+                print " --> Resuming the previous install, not formatting partitions"
+            else:
+                self.step_format_partitions(setup, skip_root=block_deploy)
+            if block_deploy:
+                self.step_deploy_image(setup)
             
             # mount all needed partitions
             self.step_mount_partitions(setup)
+            self.start_prefetch(setup)
             
             # copy root image                    
-            self.step_copy_files(source="/source/rootfs/", destination="/target/")
-
-            # Steps:
-            our_total = 14
-            our_current = 0
-            # chroot
-            print " --> Chrooting"
-            self.update_progress(total=our_total, current=our_current, message="Entering new system..")
-
-            # setup mountpoints
-            if(not os.path.exists("/target/proc")):
-                os.mkdir("/target/proc")
-            self.do_run("mount -t proc proc /target/proc/")
-
-            if(not os.path.exists("/target/sys")):
-                os.mkdir("/target/sys")
-            self.do_run("mount -t sysfs sys /target/sys/")
-
-            if(not os.path.exists("/target/dev")):
-                os.mkdir("/target/dev")
-            self.do_run("mount --bind /dev/ /target/dev/")
-
-            # shared memory
-            if(not os.path.exists("/target/dev/shm")):
-                os.mkdir("/target/dev/shm")
-            self.do_run("mount --bind /dev/shm/ /target/dev/shm/")
-
-            # important for pacman (for signature check)
-            if(not os.path.exists("/target/dev/pts")):
-                os.mkdir("/target/dev/pts")
-            self.do_run("mount -t devpts pts /target/dev/pts/")
-
-            # this is needed to use networking within the chroot
-            self.do_run("cp -f /etc/resolv.conf /target/etc/resolv.conf")
-
-            # initialize pacman keyring
-            print " --> Initializing pacman keyring"
-            self.update_progress(total=0, current=0, message="Configuring Pacman")
-            our_current += 1
-            self.do_run_in_chroot("rm -rf /etc/pacman.d/gnupg")
-            self.do_run_in_chroot("pacman-key --init")
-            self.do_run_in_chroot("pacman-key --populate archlinux")
-            self.do_run_in_chroot("pacman-key --populate lucidsystems")
-            self.do_run_in_chroot("pacman-key --refresh-keys")
-
-            # optimize mirrorlist
-            our_current += 1
-            if (setup.internet_connectivity == True):
-                print " --> Optimizing pacman mirrorlist"
-                self.update_progress(total=our_total, current=our_current, message="Optimizing pacman mirrorlist")
-                self.do_run_in_chroot("pacman -S --noconfirm reflector")
-                self.do_run_in_chroot("reflector -l 8 --sort rate --save /etc/pacman.d/mirrorlist")
+            if block_deploy:
+                self.step_remove_excluded("/target/")
             else:
-                self.update_progress(total=our_total, current=our_current, message="Skip optimizing pacman mirrorlist")
-
-            # remove live configuration packages
-            print " --> Removing livesystem configuration"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Removing livesystem configuration")
-            self.do_run_in_chroot("pacman -R --noconfirm lucidsystems-installer")
-            self.do_run_in_chroot("pacman -R --noconfirm lucidsystems-livemedia")
-            
-            if(os.path.exists("/target/etc/skel/Desktop/lucidsystems-Installer.desktop")):
-                self.do_run_in_chroot("rm -f /etc/skel/Desktop/lucidsystems-Installer.desktop")
-
-            if(os.path.exists("/target/usr/share/applications/lucidsystems-installer-launcher.desktop")):
-                self.do_run_in_chroot("rm -f /usr/share/applications/lucidsystems-installer-launcher.desktop")
-
-            if(os.path.exists("/target/etc/skel/.config/autostart/lucidsystems-greeter.desktop")):
-                self.do_run_in_chroot("rm -f /etc/skel/.config/autostart/lucidsystems-greeter.desktop")
-
-            # remove liveuser service
-            if(os.path.exists("/target/usr/bin/prepare_livesystem")):
-                self.do_run_in_chroot("rm -rf /usr/bin/prepare_livesystem")
-            if(os.path.exists("/target/etc/systemd/system/prepare_livesystem.service")):
-                self.do_run_in_chroot("rm -rf /etc/systemd/system/prepare_livesystem.service")
-            if(os.path.exists("/target/etc/systemd/system/multi-user.target.wants/prepare_livesystem.service")):
-                self.do_run_in_chroot("rm -rf /etc/systemd/system/multi-user.target.wants/prepare_livesystem.service")
-
-            # add new user
-            print " --> Adding new user"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Creating new user")         
-            self.do_run_in_chroot("useradd -s %s -c \'%s\' -G audio,games,lp,nopasswdlogin,optical,power,scanner,shutdown,storage,sudo,video -m %s" % ("/bin/bash", setup.real_name, setup.username))
-            newusers = open("/target/tmp/newusers.conf", "w")
-            newusers.write("%s:%s\n" % (setup.username, setup.password1))
-            newusers.write("root:%s\n" % setup.password1)
-            newusers.close()
-            self.do_run_in_chroot("cat /tmp/newusers.conf | chpasswd")
-            self.do_run_in_chroot("rm -rf /tmp/newusers.conf")
-            
-            # write the /etc/fstab
-            print " --> Writing fstab"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Writing filesystem mount information")
-            # make sure fstab has default /proc and /sys entries
-            if(not os.path.exists("/target/etc/fstab")):
-                self.do_run("echo \"#### Static Filesystem Table File\" > /target/etc/fstab")
-            fstab = open("/target/etc/fstab", "a")
-            fstab.write("proc\t/proc\tproc\tdefaults\t0\t0\n")
-            for partition in setup.partitions:
-                if (partition.mount_as is not None and partition.mount_as != "None"):
-                    partition_uuid = partition.partition.path # If we can't find the UUID we use the path
-                    try:                    
-                        blkid = commands.getoutput('blkid').split('\n')
-                        for blkid_line in blkid:
-                            blkid_elements = blkid_line.split(':')
-                            if blkid_elements[0] == partition.partition.path:
-                                blkid_mini_elements = blkid_line.split()
-                                for blkid_mini_element in blkid_mini_elements:
-                                    if "UUID=" in blkid_mini_element:
-                                        partition_uuid = blkid_mini_element.replace('"', '').strip()
-                                        break
-                                break
-                    except Exception:
-                        print '-'*60
-                        traceback.print_exc(file=sys.stdout)
-                        print '-'*60
-                                        
-                    fstab.write("# %s\n" % (partition.partition.path))                            
-                    
-                    if(partition.mount_as == "/"):
-                        fstab_fsck_option = "1"
-                    else:
-                        fstab_fsck_option = "0" 
-                                            
-                    if("ext" in partition.type):
-                        fstab_mount_options = "rw,errors=remount-ro"
-                    else:
-                        fstab_mount_options = "defaults"
-                        
-                    if(partition.type == "swap"):                    
-                        fstab.write("%s\tswap\tswap\tsw\t0\t0\n" % partition_uuid)
-                    else:                                                    
-                        fstab.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (partition_uuid, partition.mount_as, partition.type, fstab_mount_options, "0", fstab_fsck_option))
-            fstab.close()
-            
-            # write host+hostname infos
-            print " --> Writing hostname"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Setting hostname")
-            hostnamefh = open("/target/etc/hostname", "w")
-            hostnamefh.write("%s\n" % setup.hostname)
-            hostnamefh.close()
-            hostsfh = open("/target/etc/hosts", "w")
-            hostsfh.write("127.0.0.1\tlocalhost\n")
-            hostsfh.write("127.0.1.1\t%s\n" % setup.hostname)
-            hostsfh.write("# The following lines are desirable for IPv6 capable hosts\n")
-            hostsfh.write("::1     localhost ip6-localhost ip6-loopback\n")
-            hostsfh.write("fe00::0 ip6-localnet\n")
-            hostsfh.write("ff00::0 ip6-mcastprefix\n")
-            hostsfh.write("ff02::1 ip6-allnodes\n")
-            hostsfh.write("ff02::2 ip6-allrouters\n")
-            hostsfh.write("ff02::3 ip6-allhosts\n")
-            hostsfh.close()
-
-            # set the locale
-            print " --> Setting the locale"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Setting locale")
-            self.do_run("echo \"%s.UTF-8 UTF-8\" >> /target/etc/locale.gen" % setup.locale_code)
-            self.do_run_in_chroot("locale-gen")
-            self.do_run("echo \"\" > /target/etc/default/locale")
-            self.do_run_in_chroot("echo \"LANG=%s.UTF-8\" > /etc/locale.conf" % setup.locale_code)
-            self.do_run_in_chroot("echo \"LC_TIME=%s.UTF-8\" >> /etc/locale.conf" % setup.locale_code)
-
-            # set the timezone
-            print " --> Setting the timezone"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Setting timezone")
-            self.do_run("echo \"%s\" > /target/etc/timezone" % setup.timezone_code)
-            self.do_run_in_chroot("rm -f /etc/localtime")
-            self.do_run_in_chroot("ln -s /usr/share/zoneinfo/%s /etc/localtime" % setup.timezone)
-
-            # set the keyboard options..
-            print " --> Configuring keyboard"
-            our_current += 1
-            self.update_progress(total=our_total, current=our_current, message="Configuring Keyboard")
-            self.do_run_in_chroot("echo \"KEYMAP=%s\" > /etc/vconsole.conf" % setup.keyboard_layout)
-            self.do_run_in_chroot("echo \"FONT=\" >> /etc/vconsole.conf")
-            self.do_run_in_chroot("echo \"FONT_MAP=\" >> /etc/vconsole.conf")
-            
-            # create xorg config for keyboard
-            keyboardfh = open("/target/etc/X11/xorg.conf.d/90-keyboard-layouts.conf", "w")
-            keyboardfh.write("Section \"InputClass\"\n")
-            keyboardfh.write("  Identifier      \"MainKeyboard\"\n")
-            keyboardfh.write("  MatchIsKeyboard \"on\"\n")
-            keyboardfh.write("  MatchDevicePath \"/dev/input/event*\"\n")
-            keyboardfh.write("  Driver          \"evdev\"\n")
-            keyboardfh.write("  Option          \"XkbModel\"      \"%s\"\n" % setup.keyboard_model)
-            keyboardfh.write("  Option          \"XkbLayout\"     \"%s\"\n" % setup.keyboard_layout)
-            keyboardfh.write("  Option          \"XkbVariant\"    \"%s\"\n" % setup.keyboard_variant)
-            keyboardfh.write("  Option          \"XkbOptions\"    \"\"\n")
-            keyboardfh.write("EndSection\n")
-            keyboardfh.close()
-
-            # configure lightdm
-            print " --> Configuring LightDM"
-            self.update_progress(total=our_total, current=our_current, message="Configuring LightDM")
-            our_current += 1
-            lightdmconfig = open("/target/etc/lightdm/lightdm.conf", "r")
-            newlightdmconfig = open("/target/etc/lightdm/lightdm.conf.new", "w")
-            for line in lightdmconfig:
-                line = line.rstrip("\r\n")
-                if(line.startswith("greeter-session=")):
-                    newlightdmconfig.write("greeter-session=lightdm-gtk-greeter\n")
-                elif(line.startswith("#greeter-session=")):
-                    newlightdmconfig.write("greeter-session=lightdm-gtk-greeter\n")
-                else:
-                    newlightdmconfig.write("%s\n" % line)
-            lightdmconfig.close()
-            newlightdmconfig.close()
-            self.do_run_in_chroot("rm /etc/lightdm/lightdm.conf")
-            self.do_run_in_chroot("mv /etc/lightdm/lightdm.conf.new /etc/lightdm/lightdm.conf")
-
-            # generate ramdisk
-            print " --> Generating Ramdisk"
-            self.update_progress(total=0, current=0, message="Generating ramdisk")
-            our_current += 1
-            self.do_run_in_chroot("mkinitcpio -p linux")
-
-            # install grub
-            print " --> Configuring Grub"
-            our_current += 1
-            if(setup.bootloader_device is not None):
-                self.update_progress(total=our_total, current=our_current, message="Installing bootloader")
-
-                if(self.setup.bios_type == "efi"):
-                    # EFI
-                    print " --> Installing grub (efi)"
-                    self.do_run_in_chroot("pacman -S --noconfirm --force %s" % setup.bootloader_type)
-                    if(not os.path.exists("/target%s" % setup.bootloader_device)):
-                        os.mkdir("/target%s" % setup.bootloader_device)
-                    self.do_run_in_chroot("grub-install --target=x86_64-efi --efi-directory=%s --bootloader-id=lucidsystems --force"  % setup.bootloader_device)
-                else:
-                    # BIOS
-                    print " --> Installing grub (bios)"
-                    self.do_run_in_chroot("pacman -S --noconfirm --force %s" % setup.bootloader_type)
-                    self.do_run_in_chroot("grub-install --target=i386-pc --force %s" % setup.bootloader_device)
-
-                if(not os.path.exists("/target/boot/grub/locale")):
-                    os.mkdir("/target/boot/grub/locale")
-                self.do_run_in_chroot("cp /usr/share/locale/en\@quot/LC_MESSAGES/grub.mo /boot/grub/locale/en.mo")
-
-                self.do_configure_grub(our_total, our_current)
-                grub_retries = 0
-                while (not self.do_check_grub(our_total, our_current)):
-                    self.do_configure_grub(our_total, our_current)
-                    grub_retries = grub_retries + 1
-                    if grub_retries >= 5:
-                        self.error_message(message="The bootloader wasn't configured properly! You need to configure it manually.", critical=True)
-                        self.exit(2)
-                        break
+                self.step_copy_files(source="/source/rootfs/", destination="/target/")
 
-            # install user selected packages
-            our_current += 1
-            if (setup.internet_connectivity == True):
-                if setup.installList:
-                    print " --> Installing additional packages"
-                    for package in setup.installList:
-                        self.update_progress(total=our_total, current=our_current, message="Installing %s" % package)
-                        self.do_run_in_chroot("pacman -S --noconfirm %s" % package)
+            # configure the installed system, independent steps overlap
+            self.progress.end_stages()
+            StepScheduler(self.post_copy_steps(setup), self.post_install_jobs, self.progress).run()
 
             # now unmount it
-            our_current += 1
-            print " --> Unmounting partitions"
+            self.begin_stage("unmount", "Unmounting partitions")
             try:
+                # nothing may keep the target busy
+                self.close_chroot()
+                self.package_sources.release()
+                if self.prefetcher is not None:
+                    self.prefetcher.store("/target/var/cache/pacman/pkg")
+                if os.path.exists(os.path.join("/target", self.copy_journal)):
+                    os.remove(os.path.join("/target", self.copy_journal))
                 self.do_run("umount --force /target/dev/shm")
                 self.do_run("umount --force /target/dev/pts")
                 self.do_run("umount --force /target/dev/")
                 self.do_run("umount --force /target/sys/")
                 self.do_run("umount --force /target/proc/")
-                self.do_run("rm -rf /target/etc/resolv.conf")
+                self.target_config.remove("etc/resolv.conf")
+                self.events.copy_to("/target/var/log/lucidsystems-installer-events.jsonl")
                 for partition in setup.partitions:
                     if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
                         self.do_unmount("/target" + partition.mount_as)
@@ -511,9 +430,14 @@ class InstallerEngine(QtCore.QThread):
                 traceback.print_exc(file=sys.stdout)
                 print '-'*60
 
-            self.update_progress(total=100, current=100, message="Installation finished")
+            self.progress.finish()
+            self.update_progress(total=0, current=0, message="Installation finished")
+            self.stage_times.save()
+            self.events.close()
             print " --> All done"
 
+            # make sure the UI has seen the final state before the page changes
+            self.sampler.stop()
             self.emit(QtCore.SIGNAL("installFinished()"))
             self.exit(0)
             
@@ -521,31 +445,401 @@ class InstallerEngine(QtCore.QThread):
             print '-'*60
             traceback.print_exc(file=sys.stdout)
             print '-'*60
+            self.progress.finish("failed")
+            self.events.close("failed")
+
+    def edit_lightdm_line(self, line):
+        line = line.rstrip("\r")
+        if(line.startswith("greeter-session=")):
+            return "greeter-session=lightdm-gtk-greeter"
+        elif(line.startswith("#greeter-session=")):
+            return "greeter-session=lightdm-gtk-greeter"
+        return line
+
+    def post_copy_steps(self, setup):
+        ''' The steps configuring the copied system, in the order they'd run
+            one after another. Locks: "pacman db" for pacman transactions,
+            "accounts" for the users and groups packages add, "initramfs"
+            for the images in /boot. '''
+        steps = [Step("chroot", partial(self.step_prepare_chroot, setup), "Entering new system.."),
+                 Step("keyring", partial(self.step_keyring, setup), "Configuring Pacman", requires=["chroot"])]
+        if setup.internet_connectivity == True:
+            steps.append(Step("mirrors", partial(self.step_mirrors, setup), "Optimizing pacman mirrorlist"))
+        steps.extend([Step("user", partial(self.step_user, setup), "Creating new user", requires=["chroot"], locks=["accounts"]),
+                      Step("fstab", partial(self.step_fstab, setup), "Writing filesystem mount information"),
+                      Step("hostname", partial(self.step_hostname, setup), "Setting hostname"),
+                      Step("locale", partial(self.step_locale, setup), "Setting locale", requires=["chroot"]),
+                      Step("timezone", partial(self.step_timezone, setup), "Setting timezone"),
+                      Step("keyboard", partial(self.step_keyboard, setup), "Configuring Keyboard"),
+                      Step("lightdm", partial(self.step_lightdm, setup), "Configuring LightDM"),
+                      # mkinitcpio reads the keymap from vconsole.conf
+                      Step("ramdisk", partial(self.step_ramdisk, setup), "Generating ramdisk", requires=["chroot", "keyboard"], locks=["initramfs"])])
+        if len(self.packages_plan(setup)):
+            # packages may run hooks rebuilding the initramfs
+            steps.append(Step("packages", partial(self.step_packages, setup), "Installing additional packages", requires=["keyring", "mirrors"], locks=["pacman db", "accounts", "initramfs"]))
+        if setup.bootloader_device is not None:
+            # the grub config lists the kernels and images in /boot
+            steps.append(Step("bootloader", partial(self.step_bootloader, setup), "Installing bootloader", requires=["keyring", "mirrors", "ramdisk", "packages"], locks=["pacman db", "accounts", "initramfs"]))
+        return steps
+
+    def bootloader_plan(self, setup):
+        ''' The bootloader package, a transaction of its own so the selected
+            packages can't keep it from being installed '''
+        plan = TransactionPlan(self.do_run_in_chroot, self.package_sources.options(), force=True)
+        if setup.bootloader_device is not None:
+            plan.install([setup.bootloader_type])
+        return plan
+
+    def packages_plan(self, setup):
+        ''' The user selected packages, in a single pacman transaction '''
+        plan = TransactionPlan(self.do_run_in_chroot, self.package_sources.options())
+        if setup.internet_connectivity == True:
+            plan.install(setup.installList)
+        elif setup.installList:
+            # without a network only what's here can be installed
+            plan.install(self.package_sources.provides(setup.installList))
+        return plan
+
+    def prefetch_packages(self, setup):
+        ''' The packages the install is going to download '''
+        if not self.prefetch or setup.internet_connectivity != True:
+            return []
+        return self.bootloader_plan(setup).installs + self.packages_plan(setup).installs
+
+    def start_prefetch(self, setup):
+        ''' Download the packages in the background, into a cache on the
+            target's disk which the installs in the target use '''
+        packages = self.prefetch_packages(setup)
+        if not packages:
+            return
+        cache_dir = "/target/var/cache/lucidsystems-installer/prefetch"
+        self.prefetcher = Prefetcher(packages, cache_dir, "/target/var/cache/lucidsystems-installer/prefetch-db", self.do_run, self.progress)
+        self.package_sources.caches.append(cache_dir)
+        self.prefetcher.start()
+
+    def wait_prefetch(self):
+        if self.prefetcher is not None:
+            self.update_progress(total=0, current=0, message="Waiting for the package downloads")
+            self.prefetcher.wait()
+
+    def step_prepare_chroot(self, setup):
+        ''' Mount the virtual filesystems and make the network usable in /target '''
+
+        # setup mountpoints
+        if(not os.path.exists("/target/proc")):
+            os.mkdir("/target/proc")
+        self.do_run("mount -t proc proc /target/proc/")
+
+        if(not os.path.exists("/target/sys")):
+            os.mkdir("/target/sys")
+        self.do_run("mount -t sysfs sys /target/sys/")
+
+        if(not os.path.exists("/target/dev")):
+            os.mkdir("/target/dev")
+        self.do_run("mount --bind /dev/ /target/dev/")
+
+        # shared memory
+        if(not os.path.exists("/target/dev/shm")):
+            os.mkdir("/target/dev/shm")
+        self.do_run("mount --bind /dev/shm/ /target/dev/shm/")
+
+        # important for pacman (for signature check)
+        if(not os.path.exists("/target/dev/pts")):
+            os.mkdir("/target/dev/pts")
+        self.do_run("mount -t devpts pts /target/dev/pts/")
+
+        # this is needed to use networking within the chroot
+        self.target_config.copy_in("/etc/resolv.conf", "etc/resolv.conf", optional=True)
+
+        # local package caches and repositories
+        self.package_sources.prepare()
+
+    def step_keyring(self, setup):
+        ''' Initialize the pacman keyring '''
+        if self.keyring_mode != "generate" and self.keyring_snapshot.available():
+            print " --> Installing the keyring snapshot %s" % self.keyring_snapshot.path
+            self.keyring_snapshot.install(self.target_config.path("etc/pacman.d/gnupg"))
+            # the master key of the snapshot is someone else's
+            keys = []
+            self.do_run_in_chroot("gpg --homedir /etc/pacman.d/gnupg --batch --with-colons --with-fingerprint --list-keys %s" % MASTER_KEY_UID, output=keys)
+            for fingerprint in master_fingerprints(keys):
+                self.do_run_in_chroot("gpg --homedir /etc/pacman.d/gnupg --batch --yes --delete-keys %s" % fingerprint)
+            self.do_run_in_chroot("pacman-key --init")
+            # the keys are there already, this only signs them
+            self.do_run_in_chroot("pacman-key --populate archlinux lucidsystems")
+        else:
+            if self.keyring_mode == "snapshot":
+                print " --> No keyring snapshot in %s, generating the keyring" % self.keyring_snapshot.path
+            self.target_config.remove("etc/pacman.d/gnupg")
+            self.do_run_in_chroot("pacman-key --init")
+            self.do_run_in_chroot("pacman-key --populate archlinux")
+            self.do_run_in_chroot("pacman-key --populate lucidsystems")
+        if self.keyring_refresh and setup.internet_connectivity == True:
+            # the keyservers are asked key by key, don't wait forever
+            if self.do_run_in_chroot("timeout -k 10 %d pacman-key --refresh-keys" % self.keyring_refresh_timeout) == 124:
+                print " --> Refreshing the keyring took longer than %d seconds, stopped" % self.keyring_refresh_timeout
+
+    def step_mirrors(self, setup):
+        ''' Optimize the pacman mirrorlist, keeping the fastest mirrors '''
+        servers = select_mirrors(parse_mirrorlist(self.target_config.read("etc/pacman.d/mirrorlist")), self.mirror_countries, self.mirror_candidates)
+        if not servers:
+            print " --> No mirrors to probe in /etc/pacman.d/mirrorlist"
+            return
+        ranking = self.mirror_cache.load(servers)
+        if ranking is not None:
+            print " --> Using the mirror ranking of %s" % self.mirror_cache.path
+        else:
+            self.update_progress(total=0, current=0, message="Probing %d mirrors" % len(servers))
+            ranking = MirrorRanker(servers, self.mirror_timeout, max_lag=self.mirror_max_lag).rank()
+            if ranking:
+                self.mirror_cache.save(servers, ranking)
+        if not ranking:
+            print " --> No mirror answered, keeping the mirrorlist"
+            return
+        self.target_config.write("etc/pacman.d/mirrorlist", format_mirrorlist(ranking, self.mirror_count))
+
+    def step_user(self, setup):
+        ''' Add the new user '''
+        self.do_run_in_chroot("useradd -s %s -c \'%s\' -G audio,games,lp,nopasswdlogin,optical,power,scanner,shutdown,storage,sudo,video -m %s" % ("/bin/bash", setup.real_name, setup.username))
+        # only readable by root
+        self.target_config.write_lines("tmp/newusers.conf", ["%s:%s" % (setup.username, setup.password1), "root:%s" % setup.password1], 0600)
+        self.do_run_in_chroot("chpasswd < /tmp/newusers.conf")
+        self.target_config.remove("tmp/newusers.conf")
+
+    def step_fstab(self, setup):
+        ''' Write the /etc/fstab '''
+        # make sure fstab has default /proc and /sys entries
+        fstab = []
+        if(not os.path.exists("/target/etc/fstab")):
+            fstab.append("#### Static Filesystem Table File")
+        fstab.append("proc\t/proc\tproc\tdefaults\t0\t0")
+        for partition in setup.partitions:
+            if (partition.mount_as is not None and partition.mount_as != "None"):
+                partition_uuid = partition.partition.path # If we can't find the UUID we use the path
+                try:                    
+                    blkid = commands.getoutput('blkid').split('\n')
+                    for blkid_line in blkid:
+                        blkid_elements = blkid_line.split(':')
+                        if blkid_elements[0] == partition.partition.path:
+                            blkid_mini_elements = blkid_line.split()
+                            for blkid_mini_element in blkid_mini_elements:
+                                if "UUID=" in blkid_mini_element:
+                                    partition_uuid = blkid_mini_element.replace('"', '').strip()
+                                    break
+                            break
+                except Exception:
+                    print '-'*60
+                    traceback.print_exc(file=sys.stdout)
+                    print '-'*60
+                                    
+                fstab.append("# %s" % (partition.partition.path))
+                
+                if(partition.mount_as == "/"):
+                    fstab_fsck_option = "1"
+                else:
+                    fstab_fsck_option = "0" 
+                                        
+                if("ext" in partition.type):
+                    fstab_mount_options = "rw,errors=remount-ro"
+                else:
+                    fstab_mount_options = "defaults"
+                    
+                if(partition.type == "swap"):                    
+                    fstab.append("%s\tswap\tswap\tsw\t0\t0" % partition_uuid)
+                else:                                                    
+                    fstab.append("%s\t%s\t%s\t%s\t%s\t%s" % (partition_uuid, partition.mount_as, partition.type, fstab_mount_options, "0", fstab_fsck_option))
+        self.target_config.append_lines("etc/fstab", fstab)
+
+    def step_hostname(self, setup):
+        ''' Write host+hostname infos '''
+        self.target_config.write_lines("etc/hostname", [setup.hostname])
+        self.target_config.write_lines("etc/hosts", ["127.0.0.1\tlocalhost",
+                                                     "127.0.1.1\t%s" % setup.hostname,
+                                                     "# The following lines are desirable for IPv6 capable hosts",
+                                                     "::1     localhost ip6-localhost ip6-loopback",
+                                                     "fe00::0 ip6-localnet",
+                                                     "ff00::0 ip6-mcastprefix",
+                                                     "ff02::1 ip6-allnodes",
+                                                     "ff02::2 ip6-allrouters",
+                                                     "ff02::3 ip6-allhosts"])
+
+    def step_locale(self, setup):
+        ''' Set the locale '''
+        self.target_config.append_lines("etc/locale.gen", ["%s.UTF-8 UTF-8" % setup.locale_code])
+        self.do_run_in_chroot("locale-gen")
+        self.target_config.write_lines("etc/default/locale", [""])
+        self.target_config.write_lines("etc/locale.conf", ["LANG=%s.UTF-8" % setup.locale_code, "LC_TIME=%s.UTF-8" % setup.locale_code])
+
+    def step_timezone(self, setup):
+        ''' Set the timezone '''
+        self.target_config.write_lines("etc/timezone", [setup.timezone_code])
+        self.target_config.symlink("etc/localtime", "/usr/share/zoneinfo/%s" % setup.timezone)
+
+    def step_keyboard(self, setup):
+        ''' Set the keyboard options '''
+        self.target_config.write_lines("etc/vconsole.conf", ["KEYMAP=%s" % setup.keyboard_layout, "FONT=", "FONT_MAP="])
+        
+        # create xorg config for keyboard
+        self.target_config.write_lines("etc/X11/xorg.conf.d/90-keyboard-layouts.conf", ["Section \"InputClass\"",
+                                                                                        "  Identifier      \"MainKeyboard\"",
+                                                                                        "  MatchIsKeyboard \"on\"",
+                                                                                        "  MatchDevicePath \"/dev/input/event*\"",
+                                                                                        "  Driver          \"evdev\"",
+                                                                                        "  Option          \"XkbModel\"      \"%s\"" % setup.keyboard_model,
+                                                                                        "  Option          \"XkbLayout\"     \"%s\"" % setup.keyboard_layout,
+                                                                                        "  Option          \"XkbVariant\"    \"%s\"" % setup.keyboard_variant,
+                                                                                        "  Option          \"XkbOptions\"    \"\"",
+                                                                                        "EndSection"])
+
+    def step_lightdm(self, setup):
+        ''' Configure LightDM '''
+        self.target_config.edit_lines("etc/lightdm/lightdm.conf", self.edit_lightdm_line)
+
+    def step_ramdisk(self, setup):
+        ''' Generate the ramdisk '''
+        self.do_run_in_chroot("mkinitcpio -p linux")
+
+    def step_bootloader(self, setup):
+        ''' Install grub '''
+        plan = self.bootloader_plan(setup)
+        self.wait_prefetch()
+        self.update_progress(total=0, current=0, message="Installing %s" % setup.bootloader_type)
+        if plan.execute() != 0:
+            self.error_message(message="The bootloader package couldn't be installed! You need to install the bootloader manually.", critical=True)
+            return
 
-    def do_run(self, command):
-        os.system(command)
-        output = commands.getoutput(command)
-        self.update_progressTextEdit(output)
+        if(self.setup.bios_type == "efi"):
+            # EFI
+            print " --> Installing grub (efi)"
+            if(not os.path.exists("/target%s" % setup.bootloader_device)):
+                os.mkdir("/target%s" % setup.bootloader_device)
+            self.do_run_in_chroot("grub-install --target=x86_64-efi --efi-directory=%s --bootloader-id=lucidsystems --force"  % setup.bootloader_device)
+        else:
+            # BIOS
+            print " --> Installing grub (bios)"
+            self.do_run_in_chroot("grub-install --target=i386-pc --force %s" % setup.bootloader_device)
+
+        if(not os.path.exists("/target/boot/grub/locale")):
+            os.mkdir("/target/boot/grub/locale")
+        self.target_config.copy("usr/share/locale/en@quot/LC_MESSAGES/grub.mo", "boot/grub/locale/en.mo", optional=True)
+
+        self.do_configure_grub()
+        grub_retries = 0
+        while (not self.do_check_grub()):
+            self.do_configure_grub()
+            grub_retries = grub_retries + 1
+            if grub_retries >= 5:
+                self.error_message(message="The bootloader wasn't configured properly! You need to configure it manually.", critical=True)
+                self.exit(2)
+                break
 
-    def do_run_in_chroot(self, command):
-        os.system("chroot /target/ /usr/bin/sh -c \"%s\"" % command)
-        output = commands.getoutput("chroot /target/ /usr/bin/sh -c \"%s\"" % command)
-        self.update_progressTextEdit(output)
+    def step_packages(self, setup):
+        ''' Install the user selected packages '''
+        plan = self.packages_plan(setup)
+        missing = [package for package in setup.installList if package not in plan.installs]
+        if missing:
+            print " --> Not available without a network, skipping: %s" % ", ".join(missing)
+        self.wait_prefetch()
+        self.update_progress(total=0, current=0, message="Resolving packages")
+        plan.report()
+        self.update_progress(total=0, current=0, message="Installing %d packages" % len(plan.installs))
+        if plan.execute() == 0:
+            return
+        # one package took the whole transaction down, install the others
+        failed = []
+        if len(plan.installs) > 1:
+            for (index, package) in enumerate(plan.installs):
+                self.update_progress(total=len(plan.installs), current=index, message="Installing %s" % package)
+                single = TransactionPlan(self.do_run_in_chroot, self.package_sources.options())
+                single.install([package])
+                if single.execute() != 0:
+                    failed.append(package)
+        else:
+            failed = plan.installs
+        if failed:
+            self.error_message(message="These packages couldn't be installed: %s" % ", ".join(failed))
+
+    def do_execute(self, args, shell=False, output=None):
+        ''' Run a command exactly once. Its output goes to the log and to
+            the progress text line by line while it runs, and is appended
+            to output if that's a list. Returns the exit status. '''
+        if shell:
+            command = args
+        else:
+            command = " ".join(args)
+        print "EXECUTING: '%s'" % command
+        start = time.time()
+        lines = 0
+        p = Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        # readline, iterating the pipe would wait for a whole buffer
+        for line in iter(p.stdout.readline, ""):
+            self.log_output(line.rstrip("\n"), output)
+            lines += 1
+        p.stdout.close()
+        returncode = p.wait()
+        self.events.command(command, start, time.time(), returncode, lines)
+        if returncode != 0:
+            print " --> Exit status %d" % returncode
+        return returncode
+
+    def log_output(self, line, output=None):
+        print line
+        self.update_progressTextEdit(line)
+        if output is not None:
+            output.append(line)
+
+    def do_run(self, command, output=None):
+        return self.do_execute(command, shell=True, output=output)
+
+    def get_chroot(self):
+        ''' The shell session inside /target of the calling thread '''
+        session = getattr(self.chroot_local, "session", None)
+        if session is None:
+            session = ChrootSession("/target/")
+            self.chroot_local.session = session
+            self.chroot_lock.acquire()
+            self.chroot_sessions.append(session)
+            self.chroot_lock.release()
+        return session
+
+    def close_chroot(self):
+        ''' End the shell sessions of all threads '''
+        self.chroot_lock.acquire()
+        try:
+            for session in self.chroot_sessions:
+                session.close()
+        finally:
+            self.chroot_lock.release()
+
+    def do_run_in_chroot(self, command, output=None):
+        ''' Like do_run(), in the shell session inside /target '''
+        print "EXECUTING (chroot): '%s'" % command
+        start = time.time()
+        # a list, the callback can't rebind a local
+        lines = [0]
+        def log_line(line):
+            self.log_output(line, output)
+            lines[0] += 1
+        returncode = self.get_chroot().run(command, log_line)
+        self.events.command(command, start, time.time(), returncode, lines[0], chroot=True)
+        if returncode != 0:
+            print " --> Exit status %d" % returncode
+        return returncode
         
-    def do_configure_grub(self, our_total, our_current):
+    def do_configure_grub(self):
         self.update_progress(total=0, current=0, message="Configuring bootloader")
 
         # Workaround for https://bugs.archlinux.org/task/37904
-        self.do_run_in_chroot("rm -f /etc/grub.d/10_linux")
+        self.target_config.remove("etc/grub.d/10_linux")
 
         print " --> Running grub-mkconfig"
-        self.do_run_in_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
-        grub_output = commands.getoutput("chroot /target/ /usr/bin/sh -c \"grub-mkconfig -o /boot/grub/grub.cfg\"")
+        grub_output = []
+        self.do_run_in_chroot("grub-mkconfig -o /boot/grub/grub.cfg", output=grub_output)
         grubfh = open("/var/log/live-installer-grub-output.log", "w")
-        grubfh.writelines(grub_output)
+        grubfh.write("\n".join(grub_output))
         grubfh.close()
         
-    def do_check_grub(self, our_total, our_current):
+    def do_check_grub(self):
         self.update_progress(total=0, current=0, message="Checking bootloader")
         print " --> Checking Grub configuration"
         time.sleep(5)
@@ -574,31 +868,12 @@ class InstallerEngine(QtCore.QThread):
             cmd = "mount -o %s -t %s %s %s" % (options, type, device, dest)            
         else:
             cmd = "mount -t %s %s %s" % (type, device, dest)
-        print "EXECUTING: '%s'" % cmd
-        p = Popen(cmd ,shell=True)        
-        p.wait()
-        return p.returncode
+        return self.do_run(cmd)
 
     def do_unmount(self, mountpoint):
         ''' Unmount a filesystem '''
         cmd = "umount %s" % mountpoint
-        print "EXECUTING: '%s'" % cmd
-        p = Popen(cmd, shell=True)
-        p.wait()
-        return p.returncode
-
-    def do_copy_file(self, source, dest):
-        # TODO: Add md5 checks. BADLY needed..
-        BUF_SIZE = 16 * 1024
-        input = open(source, "rb")
-        dst = open(dest, "wb")
-        while(True):
-            read = input.read(BUF_SIZE)
-            if not read:
-                break
-            dst.write(read)
-        input.close()
-        dst.close()
+        return self.do_run(cmd)
 
 class Setup(object):
     locale_code = None
@@ -0,0 +1,61 @@
+import fnmatch
+import os
+import shutil
+import stat
+
+# The key pacman-key --init generates for every machine
+MASTER_KEY_UID = "pacman@localhost"
+
+# Never copied: the secret keys and the trust of the snapshot's own master
+# key, backups still holding it, and the runtime files of gpg-agent
+PRIVATE_NAMES = ("secring.gpg", "private-keys-v1.d", "openpgp-revocs.d", "trustdb.gpg", "random_seed", "*~", "*.lock", ".#*", "S.*")
+
+def master_fingerprints(lines):
+    ''' Fingerprints in the output of gpg --with-colons --list-keys '''
+    fingerprints = []
+    primary = False
+    for line in lines:
+        fields = line.split(":")
+        if fields[0] == "pub":
+            primary = True
+        elif fields[0] == "sub":
+            primary = False
+        elif fields[0] == "fpr" and primary and len(fields) > 9:
+            fingerprints.append(fields[9])
+            primary = False
+    return fingerprints
+
+class KeyringSnapshot(object):
+    ''' A pacman keyring which already holds the keys of the distribution,
+        e.g. the one of the live system which was populated and refreshed
+        when the media was built.
+
+        Only the public keys are copied, the target generates a master key
+        of its own and signs the trusted keys with it, no keyserver is
+        asked. '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def available(self):
+        return os.path.exists(os.path.join(self.path, "pubring.gpg")) or os.path.exists(os.path.join(self.path, "pubring.kbx"))
+
+    def ignore(self, directory, names):
+        ignored = set()
+        for name in names:
+            for pattern in PRIVATE_NAMES:
+                if fnmatch.fnmatch(name, pattern):
+                    ignored.add(name)
+            # sockets can't be copied
+            if name not in ignored and stat.S_ISSOCK(os.lstat(os.path.join(directory, name)).st_mode):
+                ignored.add(name)
+        return ignored
+
+    def install(self, destination):
+        ''' Replace the keyring at destination by the public part of the
+            snapshot '''
+        if os.path.isdir(destination) and not os.path.islink(destination):
+            shutil.rmtree(destination)
+        elif os.path.lexists(destination):
+            os.remove(destination)
+        shutil.copytree(self.path, destination, symlinks=True, ignore=self.ignore)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import collections
+import gzip
+import hashlib
+import os
+import stat
+import sys
+
+MANIFEST_HEADER = "# lucidsystems-installer manifest 3"
+
+# One entry of the root image. The st_* fields are named like the ones of
+# os.lstat() so an entry can be used in place of a stat result.
+ManifestEntry = collections.namedtuple("ManifestEntry", "path st_mode st_uid st_gid st_size st_atime st_mtime st_rdev st_dev st_ino st_nlink link digest")
+
+class Manifest(object):
+    ''' Index of every entry of the root image, parents before children.
+
+        On disk it's a gzipped text file, a header line with the totals
+        followed by one tab separated line per entry:
+        mode uid gid size atime mtime rdev dev ino nlink path link digest
+
+        The digest of regular files is optional, if present the header
+        names the hashlib algorithm used. '''
+
+    def __init__(self, path=None, entries=None, count=0, size=0, digest=None):
+        self.path = path
+        self.entries = entries
+        self.count = count
+        self.size = size
+        self.digest = digest
+
+    def __iter__(self):
+        if self.entries is not None:
+            return iter(self.entries)
+        return self.read_entries()
+
+    @classmethod
+    def build(cls, root, digest=None):
+        ''' Index root in a single walk, hashing regular files with the
+            digest algorithm if one is given. Every entry is stat'ed exactly
+            once, unlike os.walk() which stats directories twice. '''
+        entries = []
+        size = 0
+        # hard linked data only counts once
+        inodes = set()
+        pending = [""]
+        while pending:
+            dirpath = pending.pop()
+            subdirs = []
+            for name in sorted(os.listdir(os.path.join(root, dirpath))):
+                rpath = os.path.join(dirpath, name)
+                st = os.lstat(os.path.join(root, rpath))
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(rpath)
+                link = ""
+                file_digest = ""
+                if digest and stat.S_ISREG(st.st_mode):
+                    file_digest = hash_file(os.path.join(root, rpath), digest)
+                if stat.S_ISLNK(st.st_mode):
+                    link = os.readlink(os.path.join(root, rpath))
+                elif stat.S_ISREG(st.st_mode) and (st.st_nlink == 1 or (st.st_dev, st.st_ino) not in inodes):
+                    size += st.st_size
+                    if st.st_nlink > 1:
+                        inodes.add((st.st_dev, st.st_ino))
+                entries.append(ManifestEntry(rpath, st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_atime, st.st_mtime, st.st_rdev, st.st_dev, st.st_ino, st.st_nlink, link, file_digest))
+            # depth first, in name order
+            pending.extend(reversed(subdirs))
+        return cls(entries=entries, count=len(entries), size=size, digest=digest)
+
+    @classmethod
+    def load(cls, path):
+        ''' Read the totals of a manifest, the entries are streamed on iteration '''
+        fh = gzip.open(path, "rb")
+        try:
+            header = fh.readline().rstrip("\n")
+        finally:
+            fh.close()
+        if not header.startswith(MANIFEST_HEADER):
+            raise ValueError("%s is not a manifest" % path)
+        fields = dict(field.split("=", 1) for field in header[len(MANIFEST_HEADER):].split())
+        return cls(path=path, count=int(fields["count"]), size=int(fields["size"]), digest=fields.get("digest"))
+
+    def read_entries(self):
+        fh = gzip.open(self.path, "rb")
+        try:
+            fh.readline()
+            for line in fh:
+                (mode, uid, gid, size, atime, mtime, rdev, dev, ino, nlink, path, link, digest) = line.rstrip("\n").split("\t")
+                yield ManifestEntry(path.decode("string_escape"), int(mode, 8), int(uid), int(gid), int(size), float(atime), float(mtime), int(rdev), int(dev), int(ino), int(nlink), link.decode("string_escape"), digest)
+        finally:
+            fh.close()
+
+    def save(self, path):
+        ''' Write the manifest, atomically replacing path '''
+        tmp_path = "%s.tmp" % path
+        fh = gzip.open(tmp_path, "wb")
+        try:
+            header = "%s count=%d size=%d" % (MANIFEST_HEADER, self.count, self.size)
+            if self.digest:
+                header += " digest=%s" % self.digest
+            fh.write("%s\n" % header)
+            for entry in self:
+                fh.write("%o\t%d\t%d\t%d\t%r\t%r\t%d\t%d\t%d\t%d\t%s\t%s\t%s\n" % (entry.st_mode, entry.st_uid, entry.st_gid, entry.st_size, entry.st_atime, entry.st_mtime, entry.st_rdev, entry.st_dev, entry.st_ino, entry.st_nlink, entry.path.encode("string_escape"), entry.link.encode("string_escape"), entry.digest))
+        finally:
+            fh.close()
+        os.rename(tmp_path, path)
+        self.path = path
+
+def hash_file(path, digest):
+    hasher = hashlib.new(digest)
+    fh = open(path, "rb")
+    try:
+        while(True):
+            data = fh.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        fh.close()
+    return hasher.hexdigest()
+
+def load_manifest(root, shipped_path, cache_path):
+    ''' Use the manifest shipped with the image, then a cached one, and
+        only walk root if neither exists. A fresh index is cached. '''
+    for path in (shipped_path, cache_path):
+        if path and os.path.exists(path):
+            try:
+                print " --> Using file manifest %s" % path
+                return Manifest.load(path)
+            except Exception, e:
+                print " --> Ignoring broken manifest %s: %s" % (path, e)
+    print " --> Indexing files"
+    manifest = Manifest.build(root)
+    if cache_path:
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            manifest.save(cache_path)
+        except (IOError, OSError), e:
+            print " --> Could not cache file manifest: %s" % e
+    return manifest
+
+# Build the manifest shipped with an image:
+#   manifest.py [--digest <algorithm>] <rootfs> <output>
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    digest = None
+    if len(args) == 4 and args[0] == "--digest":
+        digest = args[1]
+        args = args[2:]
+    if len(args) != 2:
+        print "usage: %s [--digest <algorithm>] <rootfs> <manifest>" % sys.argv[0]
+        sys.exit(1)
+    root = args[0].rstrip("/") + "/"
+    Manifest.build(root, digest).save(args[1])
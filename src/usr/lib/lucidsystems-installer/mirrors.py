@@ -0,0 +1,248 @@
+import email.utils
+import httplib
+import json
+import os
+import Queue
+import re
+import socket
+import ssl
+import threading
+import time
+import urlparse
+
+from targetconfig import write_json
+
+SERVER_LINE = re.compile(r"^\s*(#?)\s*Server\s*=\s*(\S+)")
+# "## Germany" above the servers of a country in the stock mirrorlist
+COUNTRY_LINE = re.compile(r"^\s*##\s*(\S.*?)\s*$")
+
+def parse_mirrorlist(text):
+    ''' (server, country, enabled) of every server of a mirrorlist, commented
+        out or not, in order '''
+    entries = []
+    seen = set()
+    country = None
+    for line in text.splitlines():
+        match = SERVER_LINE.match(line)
+        if match is not None:
+            if match.group(2) not in seen:
+                seen.add(match.group(2))
+                entries.append((match.group(2), country, match.group(1) == ""))
+            continue
+        match = COUNTRY_LINE.match(line)
+        if match is not None:
+            country = match.group(1)
+    return entries
+
+def select_mirrors(entries, countries=(), limit=40):
+    ''' The servers worth probing: the enabled ones, or if none is enabled
+        the commented out ones of countries (all countries if empty), at
+        most limit of them '''
+    enabled = [server for (server, country, active) in entries if active]
+    if enabled:
+        return enabled[:limit]
+    countries = [country.lower() for country in countries]
+    return [server for (server, country, active) in entries if not countries or (country or "").lower() in countries][:limit]
+
+def format_mirrorlist(ranking, count):
+    ''' A mirrorlist of the count fastest servers of a ranking '''
+    lines = ["##",
+             "## pacman mirrorlist, ranked by download rate by the installer",
+             "## on %s" % time.strftime("%Y-%m-%d %H:%M:%S"),
+             "##",
+             ""]
+    for (server, rate) in ranking[:count]:
+        lines.append("# %.1f KiB/s" % (rate / 1024.0))
+        lines.append("Server = %s" % server)
+    return "".join(["%s\n" % line for line in lines])
+
+def remaining(deadline):
+    ''' Seconds left until deadline, raises socket.timeout past it '''
+    left = deadline - time.time()
+    if left <= 0:
+        raise socket.timeout("timed out")
+    return left
+
+class MirrorRanker(object):
+    ''' Ranks mirrors by the rate they deliver the database of repo at.
+
+        All mirrors are probed at the same time by workers threads. A
+        probe gives up after timeout seconds, for the connection and for
+        the whole download, and reads at most limit bytes. Mirrors which
+        fail or time out are left out of the ranking, and so are mirrors
+        whose database is more than max_lag seconds older than the newest
+        one seen, they would miss the current packages. '''
+
+    def __init__(self, servers, timeout=5, workers=16, repo="core", arch=None, limit=256 * 1024, max_lag=3600):
+        self.servers = list(servers)
+        self.timeout = timeout
+        self.workers = max(1, int(workers))
+        self.repo = repo
+        if arch is None:
+            arch = os.uname()[4]
+        self.arch = arch
+        self.limit = limit
+        self.max_lag = max_lag
+
+    def probe_url(self, server):
+        return "%s/%s.db" % (server.replace("$repo", self.repo).replace("$arch", self.arch).rstrip("/"), self.repo)
+
+    def open(self, url, deadline, sockets, redirects=3):
+        ''' (socket, response) of a GET of url, following redirects. Every
+            socket opened is added to sockets, the caller closes them. '''
+        for redirect in range(redirects + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise IOError("unsupported URL %s" % url)
+            port = parts.port or {"http": 80, "https": 443}[parts.scheme]
+            sock = socket.create_connection((parts.hostname, port), remaining(deadline))
+            sockets.append(sock)
+            if parts.scheme == "https":
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname)
+                sockets.append(sock)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            sock.settimeout(remaining(deadline))
+            sock.sendall("GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: lucidsystems-installer\r\nConnection: close\r\n\r\n" % (path, parts.netloc))
+            response = httplib.HTTPResponse(sock, method="GET")
+            sock.settimeout(remaining(deadline))
+            response.begin()
+            location = response.getheader("location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise IOError("HTTP %d %s" % (response.status, response.reason))
+            return (sock, response)
+        raise IOError("too many redirects")
+
+    def interrupt(self, sockets):
+        ''' Wake up whatever blocks on sockets past the deadline '''
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+
+    def probe(self, server):
+        ''' (bytes per second, Last-Modified time or None) of server, None if
+            it failed '''
+        url = self.probe_url(server)
+        start = time.time()
+        deadline = start + self.timeout
+        received = 0
+        sockets = []
+        # one read may wait for the socket several times, the watchdog
+        # ends it at the deadline
+        watchdog = threading.Timer(self.timeout, self.interrupt, (sockets,))
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            try:
+                (sock, response) = self.open(url, deadline, sockets)
+                while received < self.limit:
+                    sock.settimeout(remaining(deadline))
+                    data = response.read(min(64 * 1024, self.limit - received))
+                    if not data:
+                        break
+                    received += len(data)
+            finally:
+                watchdog.cancel()
+                for sock in reversed(sockets):
+                    sock.close()
+        except socket.timeout:
+            print " --> Mirror %s timed out" % server
+            return None
+        except Exception, e:
+            if time.time() >= deadline:
+                print " --> Mirror %s timed out" % server
+            else:
+                print " --> Mirror %s failed: %s" % (server, e)
+            return None
+        elapsed = time.time() - start
+        if elapsed >= self.timeout:
+            print " --> Mirror %s timed out" % server
+            return None
+        if received == 0:
+            return None
+        last_modified = None
+        date = email.utils.parsedate_tz(response.getheader("last-modified") or "")
+        if date is not None:
+            last_modified = email.utils.mktime_tz(date)
+        return (received / max(elapsed, 0.001), last_modified)
+
+    def worker(self, servers, results):
+        while True:
+            try:
+                server = servers.get_nowait()
+            except Queue.Empty:
+                return
+            results.put((server, self.probe(server)))
+
+    def rank(self):
+        ''' (server, bytes per second) of the working mirrors, fastest first '''
+        servers = Queue.Queue()
+        for server in self.servers:
+            servers.put(server)
+        results = Queue.Queue()
+        threads = []
+        for index in range(min(self.workers, len(self.servers))):
+            thread = threading.Thread(target=self.worker, args=(servers, results), name="mirror-probe-%d" % index)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        probes = []
+        while not results.empty():
+            (server, result) = results.get()
+            if result is not None:
+                probes.append((server, result[0], result[1]))
+        # mirrors which don't say how old their database is are kept
+        dates = [last_modified for (server, rate, last_modified) in probes if last_modified is not None]
+        ranking = []
+        for (server, rate, last_modified) in probes:
+            if dates and last_modified is not None and last_modified < max(dates) - self.max_lag:
+                print " --> Mirror %s is %d minutes behind, skipping it" % (server, (max(dates) - last_modified) / 60)
+                continue
+            ranking.append((server, rate))
+        ranking.sort(key=lambda entry: entry[1], reverse=True)
+        return ranking
+
+class MirrorCache(object):
+    ''' The last ranking, reused for ttl seconds as long as the mirrors to
+        rank are the same. Stored as JSON, {"time": .., "servers": [..],
+        "ranking": [[server, rate], ..]}. '''
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self, servers):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            fh = open(self.path, "r")
+            try:
+                data = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError), e:
+            print " --> Ignoring the mirror ranking %s: %s" % (self.path, e)
+            return None
+        if data.get("servers") != list(servers):
+            return None
+        age = time.time() - data.get("time", 0)
+        if age < 0 or age > self.ttl:
+            return None
+        return [tuple(entry) for entry in data.get("ranking", [])]
+
+    def save(self, servers, ranking):
+        ''' Write the ranking '''
+        if not self.path:
+            return
+        try:
+            write_json(self.path, {"time": time.time(), "servers": list(servers), "ranking": ranking})
+        except (IOError, OSError), e:
+            print " --> Could not store the mirror ranking: %s" % e
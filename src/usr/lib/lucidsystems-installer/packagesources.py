@@ -0,0 +1,226 @@
+import glob
+import os
+import shutil
+import tarfile
+
+from chroot import shell_quote
+
+# Where the sources are bind mounted, relative to the target
+MOUNT_DIR = "var/cache/lucidsystems-installer/sources"
+# pacman.conf of the target plus the sources, used instead of it
+CONFIG = "etc/pacman.lucidsystems-installer.conf"
+SYNC_DIR = "var/lib/pacman/sync"
+
+PACKAGE_PATTERNS = ("*.pkg.tar", "*.pkg.tar.*")
+
+def package_files(directory):
+    ''' The package files in directory, without their signatures '''
+    files = set()
+    for pattern in PACKAGE_PATTERNS:
+        files.update([path for path in glob.glob(os.path.join(directory, pattern)) if not path.endswith(".sig")])
+    return sorted(files)
+
+def package_name(filename):
+    ''' <name>-<pkgver>-<pkgrel>-<arch>.pkg.tar.* -> name '''
+    parts = os.path.basename(filename).split(".pkg.tar")[0].rsplit("-", 3)
+    if len(parts) < 4:
+        return None
+    return parts[0]
+
+def database_names(path):
+    ''' Names of the packages in a repository database '''
+    names = set()
+    try:
+        database = tarfile.open(path)
+        try:
+            for member in database.getmembers():
+                # <name>-<pkgver>-<pkgrel>/desc
+                entry = member.name.split("/")[0]
+                if entry.count("-") >= 2:
+                    names.add(entry.rsplit("-", 2)[0])
+        finally:
+            database.close()
+    except (IOError, OSError, tarfile.TarError), e:
+        print " --> Could not read the repository database %s: %s" % (path, e)
+    return names
+
+def parse_repository(entry):
+    ''' "name:/path" or "name:file:///path" -> (name, directory) '''
+    (name, location) = entry.split(":", 1)
+    if location.startswith("file://"):
+        location = location[len("file://"):]
+    return (name.strip(), location.strip())
+
+class PackageSources(object):
+    ''' Package files already on this machine, the live system's cache, a
+        persistence partition or a network share, made available to pacman
+        in the target so they aren't downloaded again.
+
+        caches are directories of package files, pacman takes a package
+        from them if the very same file is there. repositories are (name,
+        directory) of local repositories, listed before the repositories of
+        the target so their packages win; a missing database is built with
+        repo-add. Everything is bind mounted read-only below MOUNT_DIR and
+        pacman gets a config of its own, the target's pacman.conf stays as
+        it is.
+
+        run(command) runs a shell command on the live system. '''
+
+    def __init__(self, root, run, caches=(), repositories=()):
+        self.root = root
+        self.run = run
+        self.caches = list(caches)
+        self.repositories = list(repositories)
+        self.mounts = []
+        self.sync_files = []
+        self.prepared = False
+
+    def target_path(self, path):
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def available_caches(self):
+        return [cache for cache in self.caches if os.path.isdir(cache)]
+
+    def available_repositories(self):
+        return [(name, directory) for (name, directory) in self.repositories if os.path.isdir(directory)]
+
+    def available(self):
+        ''' Whether any package can come from this machine '''
+        return bool(self.available_caches() or self.available_repositories())
+
+    def provides(self, names):
+        ''' Those of names which a cache or a repository holds, their
+            dependencies aren't checked '''
+        found = set()
+        for cache in self.available_caches():
+            found.update([package_name(path) for path in package_files(cache)])
+        for (name, directory) in self.available_repositories():
+            if os.path.exists(self.database(name, directory)):
+                found.update(database_names(self.database(name, directory)))
+            else:
+                # the database is built from them
+                found.update([package_name(path) for path in package_files(directory)])
+        return [name for name in names if name in found]
+
+    def database(self, name, directory):
+        return os.path.join(directory, "%s.db" % name)
+
+    def build_repository(self, name, directory):
+        ''' Create the database of a directory of packages, returns whether
+            there is one '''
+        packages = package_files(directory)
+        if not packages:
+            print " --> No packages in %s" % directory
+            return False
+        if not os.access(directory, os.W_OK):
+            print " --> Can't write the database of %s to %s" % (name, directory)
+            return False
+        print " --> Building the database of %s from %d packages" % (name, len(packages))
+        self.run("repo-add %s %s" % (shell_quote(os.path.join(directory, "%s.db.tar.gz" % name)), " ".join([shell_quote(path) for path in packages])))
+        return os.path.exists(self.database(name, directory))
+
+    def bind(self, source, name):
+        mountpoint = os.path.join(MOUNT_DIR, name)
+        if not os.path.isdir(self.target_path(mountpoint)):
+            os.makedirs(self.target_path(mountpoint))
+        target = shell_quote(self.target_path(mountpoint))
+        if self.run("mount --bind %s %s" % (shell_quote(source), target)) != 0:
+            return None
+        self.mounts.append(mountpoint)
+        # read-only, downloads go to the target's own cache
+        self.run("mount -o remount,bind,ro %s" % target)
+        return "/" + mountpoint
+
+    def prepare(self):
+        ''' Mount the sources into the target and write the pacman config '''
+        if self.prepared or not self.available():
+            return
+        cache_dirs = []
+        for (index, cache) in enumerate(self.available_caches()):
+            mountpoint = self.bind(cache, "cache-%d" % index)
+            if mountpoint is not None:
+                cache_dirs.append(mountpoint)
+        repositories = []
+        existing = self.configured_repositories()
+        for (name, directory) in self.available_repositories():
+            if name in existing:
+                print " --> Not using %s, the target has a repository of that name" % directory
+                continue
+            if not os.path.exists(self.database(name, directory)) and not self.build_repository(name, directory):
+                continue
+            mountpoint = self.bind(directory, "repo-%s" % name)
+            if mountpoint is None:
+                continue
+            # what pacman -Sy would do, without refreshing every other
+            # repository over the network
+            sync_dir = self.target_path(SYNC_DIR)
+            if not os.path.isdir(sync_dir):
+                os.makedirs(sync_dir)
+            shutil.copyfile(self.database(name, directory), os.path.join(sync_dir, "%s.db" % name))
+            self.sync_files.append(os.path.join(sync_dir, "%s.db" % name))
+            repositories.append((name, mountpoint))
+        self.write_config(cache_dirs, repositories)
+        self.prepared = True
+
+    def read_config(self):
+        fh = open(self.target_path("etc/pacman.conf"), "r")
+        try:
+            return fh.read().splitlines()
+        finally:
+            fh.close()
+
+    def configured_repositories(self):
+        sections = [line.strip()[1:-1] for line in self.read_config() if line.strip().startswith("[") and line.strip().endswith("]")]
+        return [section for section in sections if section != "options"]
+
+    def write_config(self, cache_dirs, repositories):
+        lines = self.read_config()
+        has_cache_dir = len([line for line in lines if line.strip().startswith("CacheDir")]) > 0
+        config = []
+        repositories_added = False
+        for line in lines:
+            section = line.strip()
+            if section.startswith("[") and section != "[options]" and not repositories_added:
+                for (name, mountpoint) in repositories:
+                    config.extend(["[%s]" % name, "SigLevel = Optional", "Server = file://%s" % mountpoint, ""])
+                repositories_added = True
+            config.append(line)
+            if section == "[options]":
+                config.extend(["CacheDir = %s/" % cache_dir for cache_dir in cache_dirs])
+                if cache_dirs and not has_cache_dir:
+                    # naming any CacheDir replaces the default one
+                    config.append("CacheDir = /var/cache/pacman/pkg/")
+        fh = open(self.target_path(CONFIG), "w")
+        try:
+            fh.write("".join(["%s\n" % line for line in config]))
+        finally:
+            fh.close()
+        print " --> Wrote /%s with %d caches and %d repositories" % (CONFIG, len(cache_dirs), len(repositories))
+
+    def options(self):
+        ''' pacman options making it use the sources '''
+        if not self.prepared:
+            return ""
+        return "--config /%s" % CONFIG
+
+    def release(self):
+        ''' Unmount the sources, nothing of them stays in the target '''
+        for mountpoint in reversed(self.mounts):
+            path = self.target_path(mountpoint)
+            self.run("umount %s" % shell_quote(path))
+            # never remove anything through a mount that's still there
+            if not os.path.ismount(path):
+                os.rmdir(path)
+        self.mounts = []
+        for path in self.sync_files:
+            if os.path.exists(path):
+                os.remove(path)
+        self.sync_files = []
+        if os.path.exists(self.target_path(CONFIG)):
+            os.remove(self.target_path(CONFIG))
+        for directory in (MOUNT_DIR, os.path.dirname(MOUNT_DIR)):
+            try:
+                os.rmdir(self.target_path(directory))
+            except OSError:
+                pass
+        self.prepared = False
@@ -0,0 +1,72 @@
+import os
+
+# The local database of pacman, relative to the root of a system
+LOCAL_DB = "var/lib/pacman/local"
+
+def read_sections(path):
+    ''' Parse a pacman database file (desc, files) into a dict of
+        "%SECTION%" -> list of lines '''
+    sections = {}
+    current = None
+    fh = open(path, "r")
+    try:
+        for line in fh:
+            line = line.rstrip("\n")
+            if line.startswith("%") and line.endswith("%"):
+                current = sections.setdefault(line, [])
+            elif line and current is not None:
+                current.append(line)
+    finally:
+        fh.close()
+    return sections
+
+class LocalDatabase(object):
+    ''' The installed packages of the system at root, read straight from
+        the files of pacman's local database '''
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, LOCAL_DB)
+        self.entries = None
+
+    def packages(self):
+        ''' name -> directory of the package in the database '''
+        if self.entries is None:
+            self.entries = {}
+            if os.path.isdir(self.path):
+                for entry in os.listdir(self.path):
+                    # <name>-<pkgver>-<pkgrel>, only the name may contain "-"
+                    if entry.count("-") >= 2 and os.path.isdir(os.path.join(self.path, entry)):
+                        self.entries[entry.rsplit("-", 2)[0]] = entry
+        return self.entries
+
+    def files(self, name):
+        ''' Paths owned by the package, directories end with "/" '''
+        path = os.path.join(self.path, self.packages()[name], "files")
+        if not os.path.exists(path):
+            return []
+        return read_sections(path).get("%FILES%", [])
+
+    def removal_paths(self, names):
+        ''' What "pacman -R" removes for the installed packages of names,
+            relative to root: (names, paths, directories). paths are their
+            files and database entries. directories are those no other
+            package owns, pacman only removes them once they are empty. '''
+        names = [name for name in names if name in self.packages()]
+        paths = set()
+        directories = set()
+        for name in names:
+            for path in self.files(name):
+                if path.endswith("/"):
+                    directories.add(path.rstrip("/"))
+                else:
+                    paths.add(path)
+            paths.add(os.path.join(LOCAL_DB, self.packages()[name]))
+        if directories:
+            for name in self.packages():
+                if name in names:
+                    continue
+                for path in self.files(name):
+                    if path.endswith("/"):
+                        directories.discard(path.rstrip("/"))
+        return (names, paths, directories)
@@ -0,0 +1,138 @@
+import re
+
+SIZE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+
+# pacman's messages are parsed, they must not be translated
+PACMAN = "LC_ALL=C pacman"
+
+def parse_size(text):
+    ''' "1.50 MiB" -> bytes '''
+    try:
+        (number, unit) = text.split()
+        return int(float(number) * SIZE_UNITS[unit])
+    except (ValueError, KeyError):
+        return 0
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024.0
+    return "%.1f %s" % (size, unit)
+
+class TransactionPlan(object):
+    ''' Collects the packages an install adds and removes, so pacman runs
+        once for all removals and once for all installs instead of once
+        per package.
+
+        run(command, output) runs a shell command in the target, appends
+        its output lines to output and returns the exit status. options are
+        added to every pacman command, e.g. --config. force overwrites
+        conflicting files, for every package of the plan. '''
+
+    def __init__(self, run, options="", force=False):
+        self.run = run
+        self.pacman = ("%s %s" % (PACMAN, options)).strip()
+        self.installs = []
+        self.removals = []
+        self.force = force
+        self.resolved = []
+
+    def install(self, names):
+        for name in names:
+            if name not in self.installs:
+                self.installs.append(name)
+
+    def remove(self, names):
+        for name in names:
+            if name not in self.removals:
+                self.removals.append(name)
+
+    def __len__(self):
+        return len(self.installs) + len(self.removals)
+
+    def resolve(self):
+        ''' Resolve the dependencies of the installs without changing
+            anything. Packages the repositories don't know are dropped,
+            one of them would fail the whole transaction. Returns the
+            (name, version, repository) of everything to download. '''
+        while self.installs:
+            output = []
+            returncode = self.run("%s -S --needed --print --print-format '%%n %%v %%r' %s" % (self.pacman, " ".join(self.installs)), output)
+            missing = []
+            for line in output:
+                match = re.match(r"error: target not found: (\S+)", line)
+                if match is not None:
+                    missing.append(match.group(1))
+            if missing:
+                print " --> Not in the repositories, skipping: %s" % ", ".join(missing)
+                self.installs = [name for name in self.installs if name not in missing]
+                continue
+            if returncode != 0:
+                # let the real transaction report the problem
+                self.resolved = []
+                return self.resolved
+            self.resolved = [tuple(line.split()) for line in output if len(line.split()) == 3 and not line.startswith(":")]
+            return self.resolved
+        self.resolved = []
+        return self.resolved
+
+    def sizes(self, names):
+        ''' Total (download, installed) size of the packages in bytes '''
+        download = 0
+        installed = 0
+        if not names:
+            return (download, installed)
+        output = []
+        self.run("%s -Si %s" % (self.pacman, " ".join(names)), output)
+        for line in output:
+            if ":" not in line:
+                continue
+            (key, value) = [part.strip() for part in line.split(":", 1)]
+            if key == "Download Size":
+                download += parse_size(value)
+            elif key == "Installed Size":
+                installed += parse_size(value)
+        return (download, installed)
+
+    def report(self):
+        ''' Print what the transaction is going to do '''
+        if self.removals:
+            print " --> Removing %d packages: %s" % (len(self.removals), " ".join(self.removals))
+        if not self.installs:
+            return
+        resolved = self.resolve()
+        names = [entry[0] for entry in resolved]
+        dependencies = [name for name in names if name not in self.installs]
+        print " --> Installing %d packages: %s" % (len(self.installs), " ".join(self.installs))
+        if dependencies:
+            print " --> Resolved %d dependencies: %s" % (len(dependencies), " ".join(dependencies))
+        (download, installed) = self.sizes(names)
+        print " --> Download size %s, installed size %s" % (format_size(download), format_size(installed))
+
+    def commands(self):
+        ''' The pacman invocations carrying out the plan '''
+        commands = []
+        if self.removals:
+            commands.append("%s -R --noconfirm %s" % (self.pacman, " ".join(self.removals)))
+        if self.installs:
+            options = "--needed --noconfirm"
+            if self.force:
+                options += " --force"
+            commands.append("%s -S %s %s" % (self.pacman, options, " ".join(self.installs)))
+        return commands
+
+    def download(self):
+        ''' Only download the installs into the cache, returns the exit status '''
+        if not self.installs:
+            return 0
+        return self.run("%s -Sw --needed --noconfirm %s" % (self.pacman, " ".join(self.installs)), None)
+
+    def execute(self):
+        ''' Run the transactions, returns the first non-zero exit status '''
+        result = 0
+        for command in self.commands():
+            returncode = self.run(command, None)
+            if returncode != 0 and result == 0:
+                result = returncode
+        return result
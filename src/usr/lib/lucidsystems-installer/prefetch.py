@@ -0,0 +1,113 @@
+import os
+import shutil
+import sys
+import threading
+import traceback
+
+from chroot import shell_quote
+from pacmanplan import PACMAN, TransactionPlan
+from progress import ProgressState
+
+# pacman's databases on the live system
+LIVE_DBPATH = "/var/lib/pacman"
+
+class Prefetcher(threading.Thread):
+    ''' Downloads the packages of the install in the background while the
+        files are copied, so the network and the disk are busy at the same
+        time.
+
+        The packages are resolved against the live system, which is what
+        the target starts out as: pacman gets a database path of its own
+        whose local database is the live one and whose sync databases are
+        a copy of the live ones, so the live system is never locked or
+        changed. The downloads go to cache_dir, which the installs in the
+        target use as a package cache (see PackageSources).
+
+        run_command(command, output) runs a shell command on the live
+        system. '''
+
+    def __init__(self, packages, cache_dir, work_dir, run_command, progress=None, config="/etc/pacman.conf"):
+        threading.Thread.__init__(self, name="prefetch")
+        self.daemon = True
+        self.packages = list(packages)
+        self.cache_dir = cache_dir
+        self.work_dir = work_dir
+        self.run_command = run_command
+        if progress is None:
+            progress = ProgressState()
+        self.progress = progress
+        self.config = config
+        self.finished = threading.Event()
+        self.returncode = None
+
+    def dbpath(self):
+        return os.path.join(self.work_dir, "db")
+
+    def prepare_dbpath(self):
+        dbpath = self.dbpath()
+        if os.path.isdir(dbpath):
+            shutil.rmtree(dbpath)
+        os.makedirs(dbpath)
+        os.symlink(os.path.join(LIVE_DBPATH, "local"), os.path.join(dbpath, "local"))
+        sync = os.path.join(LIVE_DBPATH, "sync")
+        if os.path.isdir(sync):
+            shutil.copytree(sync, os.path.join(dbpath, "sync"))
+        else:
+            os.makedirs(os.path.join(dbpath, "sync"))
+        return len([name for name in os.listdir(os.path.join(dbpath, "sync")) if name.endswith(".db")]) > 0
+
+    def run(self):
+        self.progress.start_stage("prefetch", "Downloading packages", background=True)
+        status = "ok"
+        try:
+            self.returncode = self.download()
+            if self.returncode != 0:
+                status = "failed"
+        except Exception:
+            status = "failed"
+            print '-'*60
+            traceback.print_exc(file=sys.stdout)
+            print '-'*60
+        self.progress.end_stage("prefetch", status)
+        self.finished.set()
+
+    def download(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        options = "--config %s --dbpath %s --cachedir %s" % (shell_quote(self.config), shell_quote(self.dbpath()), shell_quote(self.cache_dir))
+        if not self.prepare_dbpath():
+            # the live system was never synced
+            self.run_command("%s %s -Sy" % (PACMAN, options), None)
+        plan = TransactionPlan(self.run_command, options)
+        plan.install(self.packages)
+        plan.report()
+        return plan.download()
+
+    def wait(self):
+        ''' Wait for the downloads, if they were started '''
+        if self.is_alive() or self.ident is not None:
+            self.finished.wait()
+
+    def store(self, package_cache):
+        ''' Move the downloaded packages to package_cache, where pacman would
+            have left them, and remove everything else. Call it after
+            PackageSources.release(), the cache is mounted until then. '''
+        self.wait()
+        if os.path.isdir(self.cache_dir):
+            if not os.path.isdir(package_cache):
+                os.makedirs(package_cache)
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".part"):
+                    continue
+                target = os.path.join(package_cache, name)
+                if not os.path.exists(target):
+                    os.rename(os.path.join(self.cache_dir, name), target)
+            shutil.rmtree(self.cache_dir)
+        if os.path.isdir(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        # the directory holding both, unless something else is in there
+        for directory in set([os.path.dirname(self.cache_dir), os.path.dirname(self.work_dir)]):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
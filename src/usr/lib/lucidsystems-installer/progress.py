@@ -0,0 +1,393 @@
+import json
+import os
+import threading
+import time
+
+from targetconfig import write_json
+
+# Rough durations of the install stages in seconds, used until an install
+# on this machine has recorded real ones
+DEFAULT_STAGE_SECONDS = {"format": 15,
+                         "deploy": 300,
+                         "resize": 30,
+                         "mount": 5,
+                         "index": 30,
+                         "copy": 600,
+                         "prefetch": 120,
+                         "chroot": 5,
+                         "keyring": 60,
+                         "mirrors": 10,
+                         "user": 5,
+                         "fstab": 2,
+                         "hostname": 1,
+                         "locale": 20,
+                         "timezone": 1,
+                         "keyboard": 1,
+                         "lightdm": 1,
+                         "ramdisk": 60,
+                         "bootloader": 60,
+                         "packages": 120,
+                         "unmount": 10}
+
+# Throughput of the counted stages until one has been measured
+DEFAULT_BYTE_RATE = 40 * 1024 * 1024
+
+class StageTimes(object):
+    ''' Durations of the install stages recorded by previous runs.
+
+        Stored as JSON, {"seconds": {stage: seconds}, "byte_rates":
+        {stage: bytes per second}}. Stages counted by bytes are estimated
+        from their throughput, all others from their duration. '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.seconds = {}
+        self.byte_rates = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            fh = open(self.path, "r")
+            try:
+                data = json.load(fh)
+            finally:
+                fh.close()
+            self.seconds.update(data.get("seconds", {}))
+            self.byte_rates.update(data.get("byte_rates", {}))
+        except (IOError, ValueError, AttributeError), e:
+            print " --> Ignoring recorded stage times %s: %s" % (self.path, e)
+
+    def expected(self, stage, bytes_total=0):
+        ''' Expected duration of a stage in seconds '''
+        if bytes_total:
+            return bytes_total / float(self.byte_rates.get(stage, DEFAULT_BYTE_RATE))
+        return float(self.seconds.get(stage, DEFAULT_STAGE_SECONDS.get(stage, 10)))
+
+    def record(self, stage, seconds, bytes_done=0):
+        ''' Average a finished stage into the recorded times, so a single
+            odd run doesn't throw off the next estimate '''
+        if bytes_done and seconds > 0:
+            rate = bytes_done / seconds
+            if stage in self.byte_rates:
+                rate = (self.byte_rates[stage] + rate) / 2.0
+            self.byte_rates[stage] = rate
+        if stage in self.seconds:
+            seconds = (self.seconds[stage] + seconds) / 2.0
+        self.seconds[stage] = seconds
+
+    def save(self):
+        ''' Write the recorded times '''
+        if not self.path:
+            return
+        try:
+            write_json(self.path, {"seconds": self.seconds, "byte_rates": self.byte_rates})
+        except (IOError, OSError), e:
+            print " --> Could not record stage times: %s" % e
+
+class ProgressState(object):
+    ''' Latest progress of the install.
+
+        The engine and the copy workers only store counters here, nothing
+        is sent to the UI until the ProgressSampler takes a snapshot.
+
+        The install is planned as a list of stages, each weighted by its
+        expected duration (see StageTimes). That gives the fraction of the
+        whole install which is done and the time that is left. Stages can
+        overlap (start_stage), the counters belong to the one started last.
+        Background stages never get the counters and only end with
+        end_stage() or finish().
+        Finished stages are written to the EventLog, if there is one. '''
+
+    def __init__(self, times=None, events=None):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.current = 0
+        self.message = ""
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.unit = "files"
+        # bumped on every change so the sampler can skip idle frames
+        self.serial = 0
+        if times is None:
+            times = StageTimes()
+        self.times = times
+        self.events = events
+        self.stages = []
+        self.expected = {}
+        # the stage the counters belong to
+        self.stage = None
+        self.stage_start = None
+        # stage -> start time of every running stage
+        self.running = {}
+        self.background = set()
+        self.done = set()
+        # bytes of the whole stage, update() only resets what's shown
+        self.stage_bytes = 0
+        self.stage_files = 0
+
+    def plan(self, stages):
+        ''' Set the stages the install is going to run, in order '''
+        self.lock.acquire()
+        self.stages = list(stages)
+        self.expected = dict([(stage, self.times.expected(stage)) for stage in self.stages])
+        self.serial += 1
+        self.lock.release()
+
+    def begin_stage(self, stage, message):
+        ''' Finish the running stages and start the next one '''
+        self.lock.acquire()
+        for running in self.running.keys():
+            if running not in self.background:
+                self.close_stage(running)
+        self.open_stage(stage, message)
+        self.lock.release()
+
+    def start_stage(self, stage, message, background=False):
+        ''' Start a stage next to the running ones '''
+        self.lock.acquire()
+        self.open_stage(stage, message, background)
+        self.lock.release()
+
+    def end_stage(self, stage, status="ok"):
+        self.lock.acquire()
+        self.close_stage(stage, status)
+        self.lock.release()
+
+    def end_stages(self, status="ok"):
+        ''' Finish the running stages, except those in the background '''
+        self.lock.acquire()
+        for running in self.running.keys():
+            if running not in self.background:
+                self.close_stage(running, status)
+        self.lock.release()
+
+    def finish(self, status="ok"):
+        ''' Finish the last stages '''
+        self.lock.acquire()
+        for running in self.running.keys():
+            self.close_stage(running, status)
+        self.lock.release()
+
+    def open_stage(self, stage, message, background=False):
+        # called with the lock held
+        if stage not in self.expected:
+            self.stages.append(stage)
+            self.expected[stage] = self.times.expected(stage)
+        if background:
+            self.running[stage] = time.time()
+            self.background.add(stage)
+            self.serial += 1
+            return
+        self.stage = stage
+        self.stage_start = time.time()
+        self.running[stage] = self.stage_start
+        self.stage_bytes = 0
+        self.stage_files = 0
+        self.unit = "files"
+        self.total = 0
+        self.current = 0
+        self.message = message
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.serial += 1
+
+    def close_stage(self, stage, status="ok"):
+        # called with the lock held
+        if stage not in self.running:
+            return
+        start = self.running.pop(stage)
+        self.background.discard(stage)
+        end = time.time()
+        bytes_done = 0
+        files = 0
+        if stage == self.stage:
+            bytes_done = self.stage_bytes
+            if self.unit == "files":
+                files = self.stage_files
+        if status == "ok":
+            # a failed stage says nothing about the next install
+            self.times.record(stage, end - start, bytes_done)
+        if self.events is not None:
+            self.events.stage(stage, start, end, status, bytes_done, files)
+        self.done.add(stage)
+        if stage == self.stage:
+            # the counters go to the latest of the others
+            self.stage = None
+            self.stage_start = None
+            self.total = 0
+            self.current = 0
+            self.bytes_total = 0
+            self.bytes_done = 0
+            others = [(start, name) for (name, start) in self.running.items() if name not in self.background]
+            if others:
+                (self.stage_start, self.stage) = max(others)
+        self.serial += 1
+
+    def update(self, total, current, message):
+        ''' Set the state of a stage which isn't counted by bytes '''
+        self.lock.acquire()
+        self.total = total
+        self.current = current
+        self.message = message
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.serial += 1
+        self.lock.release()
+
+    def set_message(self, message):
+        ''' Change the text only, the counters keep their state '''
+        self.lock.acquire()
+        self.message = message
+        self.serial += 1
+        self.lock.release()
+
+    def start_counting(self, total, bytes_total, message, unit="files"):
+        ''' Begin counting the running stage with advance() '''
+        self.lock.acquire()
+        self.unit = unit
+        self.total = total
+        self.current = 0
+        self.message = message
+        self.bytes_total = bytes_total
+        self.bytes_done = 0
+        if self.stage is not None and bytes_total:
+            self.expected[self.stage] = self.times.expected(self.stage, bytes_total)
+        self.serial += 1
+        self.lock.release()
+
+    def advance(self, message, bytes=0):
+        ''' Count one finished item of the current stage '''
+        self.lock.acquire()
+        self.current += 1
+        self.bytes_done += bytes
+        self.stage_bytes += bytes
+        self.stage_files += 1
+        self.message = message
+        self.serial += 1
+        self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            # expected seconds of the stages before and after the running
+            # ones, and (expected, elapsed) of the other running stages
+            before = 0.0
+            after = 0.0
+            expected = 0.0
+            parallel = []
+            for stage in self.stages:
+                if stage == self.stage:
+                    expected = self.expected[stage]
+                elif stage in self.running:
+                    parallel.append((self.expected[stage], now - self.running[stage]))
+                elif stage in self.done:
+                    before += self.expected[stage]
+                else:
+                    after += self.expected[stage]
+            elapsed = 0.0
+            if self.stage_start is not None and self.stage is not None:
+                elapsed = now - self.stage_start
+            return {'serial': self.serial,
+                    'total': self.total,
+                    'current': self.current,
+                    'message': self.message,
+                    'bytes_total': self.bytes_total,
+                    'bytes_done': self.bytes_done,
+                    'unit': self.unit,
+                    'stage': self.stage,
+                    'stage_elapsed': elapsed,
+                    'stage_expected': expected,
+                    'before_seconds': before,
+                    'after_seconds': after,
+                    'parallel': parallel}
+        finally:
+            self.lock.release()
+
+def estimate(snapshot):
+    ''' Returns the done fraction of the whole install and the seconds left '''
+    expected = snapshot['stage_expected']
+    if snapshot['bytes_total'] > 0:
+        fraction = snapshot['bytes_done'] / float(snapshot['bytes_total'])
+    elif snapshot['total'] > 0:
+        fraction = snapshot['current'] / float(snapshot['total'])
+    elif expected > 0:
+        # nothing to count, assume it takes as long as it used to
+        # without ever claiming to be done
+        fraction = min(snapshot['stage_elapsed'] / expected, 0.95)
+    else:
+        fraction = 0.0
+    fraction = max(0.0, min(fraction, 1.0))
+    if snapshot['bytes_total'] > 0 and snapshot['bytes_done'] > 0 and snapshot['stage_elapsed'] > 0:
+        # the average throughput of the stage so far, steadier than the
+        # rate shown next to it
+        rate = snapshot['bytes_done'] / snapshot['stage_elapsed']
+        remaining = (snapshot['bytes_total'] - snapshot['bytes_done']) / rate
+    else:
+        remaining = expected * (1.0 - fraction)
+    whole = snapshot['before_seconds'] + expected + snapshot['after_seconds']
+    done = snapshot['before_seconds'] + expected * fraction
+    # the other running stages take as long as they used to as well, they
+    # run at the same time so only the longest one counts for the time left
+    for (parallel_expected, parallel_elapsed) in snapshot['parallel']:
+        parallel_done = min(parallel_elapsed, 0.95 * parallel_expected)
+        whole += parallel_expected
+        done += parallel_done
+        remaining = max(remaining, parallel_expected - parallel_done)
+    if whole <= 0:
+        return (0.0, 0.0)
+    return (done / whole, remaining + snapshot['after_seconds'])
+
+class ProgressSampler(threading.Thread):
+    ''' Sends the latest ProgressState to the UI at a fixed frame rate '''
+
+    # stages which aren't counted still move the bar and the estimate
+    IDLE_INTERVAL = 1.0
+
+    def __init__(self, state, callback, rate=15):
+        threading.Thread.__init__(self, name="progress-sampler")
+        self.daemon = True
+        self.state = state
+        self.callback = callback
+        self.interval = 1.0 / max(1, rate)
+        self.stopped = threading.Event()
+        self.last_serial = -1
+        self.last_emit = 0
+        self.last_time = None
+        self.last_bytes = 0
+        self.rate = 0.0
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        ''' Stop sampling and send the final state '''
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.sample()
+
+    def sample(self):
+        snapshot = self.state.snapshot()
+        now = time.time()
+        # bytes per second, smoothed over a few frames
+        if self.last_time is not None and snapshot['bytes_done'] >= self.last_bytes and now > self.last_time:
+            rate = (snapshot['bytes_done'] - self.last_bytes) / (now - self.last_time)
+            self.rate = 0.7 * self.rate + 0.3 * rate
+        else:
+            self.rate = 0.0
+        self.last_time = now
+        self.last_bytes = snapshot['bytes_done']
+        if snapshot['serial'] == self.last_serial and now - self.last_emit < self.IDLE_INTERVAL:
+            return
+        self.last_serial = snapshot['serial']
+        self.last_emit = now
+        snapshot['rate'] = self.rate
+        (snapshot['fraction'], snapshot['eta']) = estimate(snapshot)
+        self.callback(snapshot)
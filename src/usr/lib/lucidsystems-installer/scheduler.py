@@ -0,0 +1,112 @@
+import sys
+import threading
+
+from progress import ProgressState
+
+class Step(object):
+    ''' A named part of the install.
+
+        requires names the steps which have to be finished first, steps
+        that aren't scheduled count as finished. Steps sharing a lock
+        (e.g. "pacman db") never run at the same time. '''
+
+    def __init__(self, name, function, message, requires=(), locks=()):
+        self.name = name
+        self.function = function
+        self.message = message
+        self.requires = tuple(requires)
+        self.locks = tuple(locks)
+
+class StepScheduler(object):
+    ''' Runs steps in worker threads as soon as their requirements are
+        finished and their locks are free, independent steps overlap.
+
+        Steps are started in the order they were added when more than one
+        could go. After a failure no more steps are started, the running
+        ones are waited for and the first error is raised. '''
+
+    def __init__(self, steps, workers=4, progress=None):
+        self.steps = list(steps)
+        self.workers = max(1, int(workers))
+        if progress is None:
+            progress = ProgressState()
+        self.progress = progress
+        names = set([step.name for step in self.steps])
+        for step in self.steps:
+            for name in step.requires:
+                if name not in names:
+                    continue
+                if self.steps.index(self.step(name)) > self.steps.index(step):
+                    raise ValueError("%s requires %s, which comes later" % (step.name, name))
+        self.condition = threading.Condition()
+        self.pending = list(self.steps)
+        self.running = set()
+        self.finished = set()
+        self.held = set()
+        self.errors = []
+
+    def step(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+        return None
+
+    def names(self):
+        return [step.name for step in self.steps]
+
+    def ready(self, step):
+        # called with the condition held
+        for name in step.requires:
+            if self.step(name) is not None and name not in self.finished:
+                return False
+        for lock in step.locks:
+            if lock in self.held:
+                return False
+        return True
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while(self.pending or self.running):
+                if not self.errors:
+                    for step in list(self.pending):
+                        if len(self.running) >= self.workers:
+                            break
+                        if self.ready(step):
+                            self.start(step)
+                elif not self.running:
+                    break
+                self.condition.wait()
+        finally:
+            self.condition.release()
+        if self.errors:
+            exc_info = self.errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def start(self, step):
+        # called with the condition held
+        self.pending.remove(step)
+        self.running.add(step.name)
+        self.held.update(step.locks)
+        print " --> %s" % step.message
+        thread = threading.Thread(target=self.execute, args=(step,), name="step-%s" % step.name)
+        thread.daemon = True
+        thread.start()
+
+    def execute(self, step):
+        self.progress.start_stage(step.name, step.message)
+        status = "ok"
+        try:
+            step.function()
+        except Exception:
+            status = "failed"
+            self.condition.acquire()
+            self.errors.append(sys.exc_info())
+            self.condition.release()
+        self.progress.end_stage(step.name, status)
+        self.condition.acquire()
+        self.running.discard(step.name)
+        self.held.difference_update(step.locks)
+        self.finished.add(step.name)
+        self.condition.notify_all()
+        self.condition.release()
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+
+def temp_path(path):
+    return os.path.join(os.path.dirname(path), ".%s.lucidsystems-installer" % os.path.basename(path))
+
+def write_file(path, content, mode=0644):
+    ''' Replace the file at path with content: written to a temporary file
+        next to it, synced and renamed over it '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = temp_path(path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        # the umask doesn't apply
+        os.fchmod(fd, mode)
+        written = 0
+        while(written < len(content)):
+            written += os.write(fd, content[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+def write_json(path, data):
+    ''' Replace the file at path with data as JSON, see write_file() '''
+    write_file(path, json.dumps(data, indent=1, sort_keys=True))
+
+class TargetConfig(object):
+    ''' Writes the configuration files of the installed system directly.
+
+        Paths are relative to the root of the target. Every change is
+        written to a temporary file next to the real one which is then
+        renamed over it, so a file is either the old or the new version,
+        never half written. '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, path):
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def read(self, path, default=""):
+        ''' Content of a file of the target, default if it doesn't exist '''
+        if not os.path.exists(self.path(path)):
+            return default
+        fh = open(self.path(path), "r")
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def write(self, path, content, mode=0644):
+        ''' Replace the file at path with content '''
+        write_file(self.path(path), content, mode)
+        print " --> Wrote /%s" % path.lstrip("/")
+
+    def write_lines(self, path, lines, mode=0644):
+        self.write(path, "".join(["%s\n" % line for line in lines]), mode)
+
+    def append_lines(self, path, lines, mode=0644):
+        ''' Add lines to the end of the file at path '''
+        content = self.read(path)
+        if content and not content.endswith("\n"):
+            content += "\n"
+        self.write(path, content + "".join(["%s\n" % line for line in lines]), mode)
+
+    def edit_lines(self, path, edit):
+        ''' Replace every line of the file at path by edit(line), keeping its
+            permissions. edit gets and returns lines without the newline. '''
+        mode = os.stat(self.path(path)).st_mode & 07777
+        self.write_lines(path, [edit(line) for line in self.read(path).splitlines()], mode)
+
+    def symlink(self, path, link_to):
+        ''' Point path at link_to, replacing whatever path was '''
+        target = self.path(path)
+        tmp_path = temp_path(target)
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(link_to, tmp_path)
+        os.rename(tmp_path, target)
+        print " --> Linked /%s to %s" % (path.lstrip("/"), link_to)
+
+    def copy_in(self, source, path, optional=False):
+        ''' Install source, a file of the live system, at path. An optional
+            source which doesn't exist (or is a dangling link) is skipped. '''
+        if optional and not os.path.exists(source):
+            print " --> Not copying %s, it doesn't exist" % source
+            return
+        fh = open(source, "r")
+        try:
+            content = fh.read()
+        finally:
+            fh.close()
+        self.write(path, content, os.stat(source).st_mode & 07777)
+
+    def copy(self, source, path, optional=False):
+        ''' Copy a file of the target to path, both relative to the target '''
+        self.copy_in(self.path(source), path, optional)
+
+    def remove(self, path):
+        ''' Remove a file or a whole directory, if it exists '''
+        target = self.path(path)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.remove(target)
+
+    def makedirs(self, path):
+        if not os.path.isdir(self.path(path)):
+            os.makedirs(self.path(path))
@@ -68,6 +68,7 @@ class InstallerWindow(QtGui.QMainWindow):
         # Installer engine
         self.installer = InstallerEngine(self.setup)
         self.connect(self.installer, QtCore.SIGNAL("progressUpdate(int, int, QString)"), self.update_progress)
+        self.connect(self.installer, QtCore.SIGNAL("progressStats(PyQt_PyObject)"), self.update_progressStats)
         self.connect(self.installer, QtCore.SIGNAL("progressUpdateTextEdit(QString)"), self.update_progressTextEdit)
         self.connect(self.installer, QtCore.SIGNAL("errorMessage(QString, bool)"), self.error_message)
         self.connect(self.installer, QtCore.SIGNAL("installFinished()"), self.install_finished)
@@ -1446,6 +1447,18 @@ class InstallerWindow(QtGui.QMainWindow):
         self.ui.installProgressBar.setValue(current)
         self.ui.installFootLabel.setText(message)
 
+    def update_progressStats(self, stats):
+        ''' Show the estimated time left, and file, byte and rate counters
+            of counted stages '''
+        text = "Progress: %d%%" % int(stats['fraction'] * 100)
+        if (stats['eta'] >= 90):
+            text += ", about %d min left" % int(round(stats['eta'] / 60.0))
+        elif (stats['fraction'] < 1):
+            text += ", less than 2 min left"
+        if (stats['bytes_total'] > 0):
+            text += " - %d of %d %s, %.2f of %.2f GB (%.1f MB/s)" % (stats['current'], stats['total'], stats['unit'], stats['bytes_done'] / 1073741824.0, stats['bytes_total'] / 1073741824.0, stats['rate'] / 1048576.0)
+        self.ui.installHeadLabel.setText(QtCore.QString(text))
+
     def update_progressTextEdit(self, text=QtCore.QString("")):
         self.ui.progressTextEdit.append(QtCore.QString.fromUtf8(text))
 
@@ -1456,6 +1469,9 @@ class InstallerWindow(QtGui.QMainWindow):
             MessageDialog("Error", str(message)).show()
     
     def install_finished(self):
+        summary = ["%-12s %8s  %-7s %s" % ("Step", "Time", "Status", "Processed")]
+        summary.extend(self.installer.events.summary())
+        self.ui.finishSummaryTextEdit.setPlainText(QtCore.QString("\n".join(summary)))
         self.setCurrentPageIndex(self.PAGE_COMPLETE)
 
 class QuestionDialog(object):